@@ -26,5 +26,11 @@ class TestPacket(unittest.TestCase):
         image.packets = (data_packet1,)
         self.assertEqual(image.get_completeness_str(), '3% (1/33)')
 
+        # Cached missing packets are refreshed when a packet is added
+        image.packets = []
+        self.assertEqual(image.get_completeness_str(), '0% (0/33)')
+        image.add_packet(data_packet1)
+        self.assertEqual(image.get_completeness_str(), '3% (1/33)')
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
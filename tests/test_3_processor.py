@@ -10,10 +10,12 @@ import time
 import os
 import shutil
 import unittest
+from concurrent.futures import Future
 import waps_ies.receiver
 import waps_ies.file_reader
 import waps_ies.processor
 import waps_ies.waps_packet
+import waps_ies.waps_image
 
 
 class TestProcessor(unittest.TestCase):
@@ -54,9 +56,120 @@ class TestProcessor(unittest.TestCase):
 
     @classmethod
     def tearDownClass(self):
+        self.receiver.file_write_executor.shutdown()
         self.receiver.database.database.close()
         del self.receiver
 
+    def test_write_file_versions(self):
+        """ Test file versioning of write_file for files with different contents """
+
+        file_path = "tests/output/write_file_test.bin"
+
+        self.assertEqual(waps_ies.processor.write_file(b'\x01', file_path), file_path)
+        self.assertEqual(waps_ies.processor.write_file(b'\x01', file_path), file_path)
+        self.assertEqual(waps_ies.processor.write_file(b'\x02', file_path),
+                         "tests/output/write_file_testv2.bin")
+        self.assertEqual(waps_ies.processor.write_file(b'\x03\x03', file_path),
+                         "tests/output/write_file_testv3.bin")
+        self.assertEqual(waps_ies.processor.write_file(b'\x02', file_path),
+                         "tests/output/write_file_testv2.bin")
+
+        # The previous save of the same image is overwritten in place
+        self.assertEqual(waps_ies.processor.write_file(b'\x04', file_path,
+                                                       known_previous=file_path), file_path)
+        with open(file_path, 'rb') as file:
+            self.assertEqual(file.read(), b'\x04')
+        self.assertFalse(os.path.exists(file_path + '.tmp'))
+
+        os.remove("tests/output/write_file_test.bin")
+        os.remove("tests/output/write_file_testv2.bin")
+        os.remove("tests/output/write_file_testv3.bin")
+
+    def test_failing_file_write_result(self):
+        """ Test that a failed file write is counted and only clears its own result """
+
+        class Image:
+            image_name = 'WAPS_test'
+
+        failed_write = Future()
+        failed_write.set_exception(OSError('disk full'))
+        successful_write = Future()
+        successful_write.set_result(('file.txt', (b'', 0, 0)))
+
+        error_count = self.receiver.unexpected_error_count
+        self.assertEqual(waps_ies.processor.get_file_write_result(failed_write, Image(),
+                                                                  self.receiver),
+                         (None, None))
+        self.assertEqual(waps_ies.processor.get_file_write_result(successful_write, Image(),
+                                                                  self.receiver),
+                         ('file.txt', (b'', 0, 0)))
+        self.assertEqual(waps_ies.processor.get_file_write_result(None, Image(), self.receiver),
+                         (None, None))
+        self.assertEqual(self.receiver.unexpected_error_count, error_count + 1)
+
+    def test_write_file_failure(self):
+        """ Test that a failed write does not leave the temporary file behind """
+
+        # A directory in place of the previous save cannot be replaced by a file
+        file_path = "tests/output/write_file_failure_test"
+        os.makedirs(file_path, exist_ok=True)
+
+        self.assertIsNone(waps_ies.processor.write_file(b'\x01', file_path,
+                                                        known_previous=file_path))
+        self.assertFalse(os.path.exists(file_path + '.tmp'))
+
+        os.rmdir(file_path)
+
+    def test_write_file_text_line_endings(self):
+        """ Test that text files are written with platform line endings """
+
+        file_path = "tests/output/write_file_test.txt"
+
+        self.assertEqual(waps_ies.processor.write_file('A0:1\nA1:2\n', file_path, 'w'), file_path)
+        with open(file_path, 'rb') as file:
+            self.assertEqual(file.read(), ('A0:1' + os.linesep + 'A1:2' + os.linesep).encode())
+
+        os.remove(file_path)
+
+    def test_write_file_digest(self):
+        """ Test that the previous save is trusted only while unchanged on disk """
+
+        file_path = "tests/output/write_file_digest_test.bin"
+
+        written, digest = waps_ies.processor.write_file_with_digest(b'\x01', file_path)
+        self.assertEqual(written, file_path)
+
+        # Same contents and unchanged file, no need to write
+        self.assertEqual(waps_ies.processor.write_file_with_digest(b'\x01', file_path, 'wb',
+                                                                   file_path, digest),
+                         (file_path, digest))
+
+        # File changed on disk since the previous save, written again
+        with open(file_path, 'wb') as file:
+            file.write(b'\x02\x02')
+        written, new_digest = waps_ies.processor.write_file_with_digest(b'\x01', file_path, 'wb',
+                                                                        file_path, digest)
+        self.assertEqual(written, file_path)
+        with open(file_path, 'rb') as file:
+            self.assertEqual(file.read(), b'\x01')
+        self.assertEqual(new_digest[1], 1)
+
+        os.remove(file_path)
+
+    def test_save_image_without_expected_packets(self):
+        """ Test that an image without expected packets is not reconstructed """
+
+        packet_list = waps_ies.file_reader.read_test_bed_file("tests/test_bed_files/EC RAW Data.txt")
+        init_packet = [packet for packet in packet_list if packet.generic_tm_id == 0x4100][0]
+        init_packet.image_number_of_packets = 0
+        image = waps_ies.waps_image.WapsImage(init_packet)
+        image.image_transmission_active = False
+
+        images = waps_ies.processor.save_images([image], 'tests/output/', self.receiver)
+        self.assertEqual(images, [image])
+        self.assertIsNone(image.latest_saved_file)
+        self.assertFalse(image.update)
+
     def test_different_ec_addresses(self):
         """ Test adding packets with different EC addresses """
 
@@ -114,6 +227,24 @@ class TestProcessor(unittest.TestCase):
             self.assertFalse(image.overwritten)
 
 
+    def test_failing_packet_does_not_stop_sorting(self):
+        """ Test that the packets after a failing one are still sorted """
+
+        class FailingPacket:
+            packet_name = 'pkt_failing'
+
+            def in_spec(self):
+                raise ValueError('Unexpected packet failure')
+
+        packet_list = waps_ies.file_reader.read_test_bed_file("tests/test_bed_files/EC RAW Data.txt")
+        error_count = self.receiver.unexpected_error_count
+
+        incomplete_images = waps_ies.processor.sort_biolab_packets([FailingPacket()] + packet_list,
+                                                                   [], self.receiver)
+
+        self.assertEqual(self.receiver.unexpected_error_count, error_count + 1)
+        self.assertEqual(len(incomplete_images), 2)
+
     def test_bed_data(self):
         """ Get packet list from the test bed output file and test sorting """
 
@@ -209,6 +340,24 @@ class TestProcessor(unittest.TestCase):
         self.assertEqual(self.receiver.incomplete_images[0].get_missing_packets(), [5])
         self.assertEqual(self.receiver.incomplete_images[1].get_missing_packets(), [2])
 
+        # Saving again without new packets keeps the saved files
+        latest_saved_file = self.receiver.incomplete_images[1].latest_saved_file
+        self.receiver.incomplete_images[1].update = True
+        self.receiver.incomplete_images = waps_ies.processor.save_images(self.receiver.incomplete_images,
+                                                                         'tests/output/',
+                                                                         self.receiver)
+        self.assertEqual(self.receiver.incomplete_images[1].latest_saved_file, latest_saved_file)
+        self.assertFalse(self.receiver.incomplete_images[1].update)
+
+        # A saved file removed from disk is written again
+        os.remove(latest_saved_file)
+        self.receiver.incomplete_images[1].update = True
+        self.receiver.incomplete_images = waps_ies.processor.save_images(self.receiver.incomplete_images,
+                                                                         'tests/output/',
+                                                                         self.receiver)
+        self.assertEqual(self.receiver.incomplete_images[1].latest_saved_file, latest_saved_file)
+        self.assertTrue(os.path.exists(latest_saved_file))
+
         # Compare original to the new JPEG files
         original_file_data = None
         new_file_data = None
@@ -32,6 +32,7 @@ class Database:
     database_image_table (str): SQL format straig of the database images table
     database_packet_table (str): SQL format straig of the database packets table
     receiver (Receiver type): current waps_ies.Receiver instance
+    latest_packet_time (str): Latest CCSDS time in the packets table, read on first use
 
     database (sqlite3 type): Database access instance
     db_cursor (cursor type): Database cursor instance
@@ -40,16 +41,20 @@ class Database:
     -------
     __init__(self, database_filename='waps_pd.db', receiver=None):
         Initialize the database with this filename and reference the receiver
-    add_packet(self, packet):
+    commit(self):
+        Commit pending database changes
+    get_latest_packet_time(self):
+        Get the latest CCSDS time in the packets table
+    add_packet(self, packet, commit=True):
         Add packet to database, if not present already
-    update_image_uuid_of_a_packet(self, packet):
+    update_image_uuid_of_a_packet(self, packet, commit=True):
         Update packet with the new image uuid
     packet_exists(self, packet):
         Check if packet already exists in the database. Matching CCSDS_time and packet_name
     retrieve_packet_by_uuid(self, packet_uuid):
         Retrieve a packet from database by UUID
 
-    add_image(self, image):
+    add_image(self, image, commit=True):
         Add image to database, if not present already
     image_exists(self, image):
         Check if image already exists in the database. Matching CCSDS_time and image_name
@@ -66,10 +71,16 @@ class Database:
         Retrieve and image from databse using its uuid
     retrieve_packets_after(self, packet):
         Retrieve packets after CCSDS time of this packet
-    update_image_status(self, image):
+    update_image_status(self, image, commit=True):
         Update an existing image in the database with status
-    update_image_filenames(self, image):
+    update_images_status(self, images, commit=True):
+        Update existing images in the database with status
+    update_image_filenames(self, image, commit=True):
         Update an existing image in the database with saved file names
+    update_images_filenames(self, images, commit=True):
+        Update existing images in the database with saved file names
+    update_overwritten_images(self, packet, commit=True):
+        Update all previous images in this memory slot as overwritten
     get_image_list(self):
         Get image list to display in GUI
     clone(self, current_time):
@@ -153,7 +164,29 @@ class Database:
             image_table_contents = ("CREATE TABLE images(" + self.database_image_table + ")")
             self.db_cursor.execute(image_table_contents)
 
-    def add_packet(self, packet):
+        # Latest packet CCSDS time, only read once packets are checked
+        self.latest_packet_time = None
+
+    def commit(self):
+        """Commit pending database changes
+        Used to group several changes into a single transaction
+        """
+
+        self.database.commit()
+
+    def get_latest_packet_time(self):
+        """Get the latest CCSDS time in the packets table
+        Read from the database once, then kept up to date by add_packet.
+        CCSDS time is compared in its stored string form, which sorts by time.
+        """
+
+        if self.latest_packet_time is None:
+            res = self.db_cursor.execute("SELECT MAX(CCSDS_time) FROM packets")
+            self.latest_packet_time = res.fetchone()[0] or ''
+
+        return self.latest_packet_time
+
+    def add_packet(self, packet, commit=True):
         """Add packet to database, if not present already"""
 
         # Avoid adding packet several times
@@ -184,9 +217,13 @@ class Database:
 
         packet_param = "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
         self.db_cursor.executemany("INSERT INTO packets VALUES" + packet_param, packet_data)
-        self.database.commit()
+        ccsds_time = str(packet.ccsds_time)
+        if ccsds_time > self.get_latest_packet_time():
+            self.latest_packet_time = ccsds_time
+        if commit:
+            self.database.commit()
 
-    def update_image_uuid_of_a_packet(self, packet):
+    def update_image_uuid_of_a_packet(self, packet, commit=True):
         """Update packet with the new image uuid"""
 
         packet_data = (packet.image_uuid,
@@ -196,14 +233,19 @@ class Database:
                                    image_id=?
                                    WHERE packet_uuid=?""",
                                    packet_data)
-        self.database.commit()
+        if commit:
+            self.database.commit()
 
     def packet_exists(self, packet):
         """
         Check if packet already exists in the database
         Matching CCSDS_time and packet_name
+        Packets later than any packet in the database are new without a database request
         """
 
+        if str(packet.ccsds_time) > self.get_latest_packet_time():
+            return False
+
         res = self.db_cursor.execute("SELECT packet_uuid FROM packets WHERE " +
                                      "CCSDS_time=? AND packet_name=?",
                                      [packet.ccsds_time, packet.packet_name])
@@ -223,7 +265,7 @@ class Database:
             return None
         return self.restore_packet_from_db_entry(res[0])
 
-    def add_image(self, image):
+    def add_image(self, image, commit=True):
         """Add image to database, if not present already"""
 
         # Avoid adding image several times
@@ -255,7 +297,8 @@ class Database:
                        image.missing_packets_string()),]
         image_param = "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
         self.db_cursor.executemany("INSERT INTO images VALUES" + image_param, image_data)
-        self.database.commit()
+        if commit:
+            self.database.commit()
         return image.uuid
 
     def image_exists(self, image):
@@ -308,10 +351,10 @@ class Database:
 
         packet_list = []
         image = None
-        for index, packet_entry in enumerate(packet_entries):
+        for packet_entry in packet_entries:
             packet = self.restore_packet_from_db_entry(packet_entry)
 
-            if packet_entries[index][7] in (0x4100, 0x5100):
+            if packet_entry[7] in waps_packet.INIT_TM_IDS:
                 image = waps_image.WapsImage(packet)
             else:
                 packet_list.append(packet)
@@ -383,27 +426,34 @@ class Database:
         packet_list = []
         for packet_entry in packet_entries:
             packet = self.restore_packet_from_db_entry(packet_entry)
-            if packet.generic_tm_id in (0x4100, 0x5100):  # New image starts here
+            if packet.generic_tm_id in waps_packet.INIT_TM_IDS:  # New image
                 break
             packet_list.append(packet)
 
         return packet_list
 
-    def update_image_status(self, image):
+    def update_image_status(self, image, commit=True):
         """Update an existing image in the database with status"""
 
-        missing_packets = image.get_missing_packets()
-        good_packets = image.number_of_packets - len(missing_packets)
+        self.update_images_status((image,), commit)
+
+    def update_images_status(self, images, commit=True):
+        """Update existing images in the database with status, in one statement"""
 
-        image_data = (good_packets,
-                      image.number_of_packets,
-                      image.overwritten,
-                      image.outdated,
-                      image.update,
-                      image.image_transmission_active,
-                      image.last_update,
-                      image.missing_packets_string(),
-                      image.uuid),
+        image_data = []
+        for image in images:
+            missing_packets = image.get_missing_packets()
+            good_packets = image.number_of_packets - len(missing_packets)
+
+            image_data.append((good_packets,
+                               image.number_of_packets,
+                               image.overwritten,
+                               image.outdated,
+                               image.update,
+                               image.image_transmission_active,
+                               image.last_update,
+                               image.missing_packets_string(missing_packets=missing_packets),
+                               image.uuid))
 
         self.db_cursor.executemany("""UPDATE images SET
                                    good_packets=?,
@@ -416,15 +466,21 @@ class Database:
                                    missing_packets=?
                                    WHERE image_uuid=?""",
                                    image_data)
-        self.database.commit()
+        if commit:
+            self.database.commit()
 
-    def update_image_filenames(self, image):
+    def update_image_filenames(self, image, commit=True):
         """Update an existing image in the database with saved file names"""
 
-        image_data = (image.latest_saved_file,
-                      image.latest_saved_file_data,
-                      image.latest_saved_file_tm,
-                      image.uuid),
+        self.update_images_filenames((image,), commit)
+
+    def update_images_filenames(self, images, commit=True):
+        """Update existing images in the database with saved file names, in one statement"""
+
+        image_data = [(image.latest_saved_file,
+                       image.latest_saved_file_data,
+                       image.latest_saved_file_tm,
+                       image.uuid) for image in images]
 
         self.db_cursor.executemany("""UPDATE images SET
                                    latest_image_file=?,
@@ -432,9 +488,10 @@ class Database:
                                    latest_tm_file=?
                                    WHERE image_uuid=?""",
                                    image_data)
-        self.database.commit()
+        if commit:
+            self.database.commit()
 
-    def update_overwritten_images(self, packet):
+    def update_overwritten_images(self, packet, commit=True):
         """Update all previous images with this ec_address, memory_slot as overwritten"""
 
         image_data = (packet.ccsds_time - timedelta(seconds=3),
@@ -450,7 +507,8 @@ class Database:
                                    memory_slot=? AND
                                    CCSDS_time<?;""",
                                    image_data)
-        self.database.commit()
+        if commit:
+            self.database.commit()
 
     def get_image_list(self):
         """Get image list to display in GUI"""
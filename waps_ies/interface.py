@@ -804,7 +804,7 @@ class WapsIesGui:
             image_name = self.db_data[table_index][4]
 
             logging.info(f'\n### Retrieving and saving {image_name}')
-            self.receiver.recover_image_uuids.append(image_uuid)
+            self.receiver.recover_image_uuids.add(image_uuid)
 
     def new_image(self):
         """New image cerating based on user input"""
@@ -17,12 +17,54 @@ Change Log:
  - Added directory creating in case the output directory was removed during operation
 """
 
-from struct import unpack, pack
+from struct import Struct, unpack_from, pack
 import logging
 import os
+import json
+import hashlib
 from datetime import datetime
 from waps_ies import waps_image
 
+# FLIR BMP file header, identical for all 80x60 FLIR images
+FLIR_BMP_HEADER = (bytes("BM", 'utf-8') +
+                   pack('IHHIIIIHHIIIIII',
+                        19200 + 54,  # file size
+                        0, 0,        # reserved
+                        54,          # offset
+                        40,          # header size
+                        80,          # image width
+                        60,          # image height
+                        1,           # planes
+                        32,          # bits per pixel
+                        0, 0,        # no compression
+                        3780, 3780,  # pixel per meter
+                        0, 0))       # unused
+
+# Start of every uCAM JPEG image
+UCAM_JPEG_HEADER = b'\xff\xd8\xff\xdb'
+
+# FLIR telemetry block: 3 x 80 big-endian 16-bit values (480 bytes)
+FLIR_TM_VALUES = Struct('>240H')
+# FLIR telemetry value labels: A0 to A79, B0 to B79 and C0 to C79
+FLIR_TM_LABELS = tuple(block + str(i) + ':' for block in 'ABC' for i in range(80))
+
+
+def index_images_by_memory_slot(images):
+    """Index images by their EC address and memory slot
+
+    Args:
+        images (list): list of active (incomplete) images
+
+    Returns:
+        slot_images (dict): lists of images keyed by (ec_address, memory_slot)
+    """
+
+    slot_images = {}
+    for image in images:
+        slot_images.setdefault((image.ec_address, image.memory_slot), []).append(image)
+
+    return slot_images
+
 
 def sort_biolab_packets(packet_list,
                         incomplete_images,
@@ -31,7 +73,7 @@ def sort_biolab_packets(packet_list,
     """Sort given packet list into images
     For each packet:
         1. Note received packet depending on the contents
-        2. Get ec_states index for EC status
+        2. Get ec_states entry for EC status
         3. Check change of memory slot in the EC throguh BIOLAB telemetry
         4. WAPS image init packet:
         4.1. Update EC state
@@ -47,6 +89,9 @@ def sort_biolab_packets(packet_list,
         5.3. Note non-existing image if no active image list found
         6. Add pcaket to the database (with assign image UUID)
         7. Return active image list
+    Active images are looked up by EC address and memory slot through an index
+    Packets are dispatched to their processing function by Generic TM ID
+
 
     Args:
         packet_list (list): packets to be sorted
@@ -59,263 +104,408 @@ def sort_biolab_packets(packet_list,
         incomplete_images (list): list of active (incomplete) images
     """
 
+    # Active images of each EC memory slot
+    slot_images = index_images_by_memory_slot(incomplete_images)
+
+    # Only build status messages that are going to be logged
+    log_info = logging.getLogger().isEnabledFor(logging.INFO)
+    log_debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+
+    # Loop invariant lookups
+    database = receiver.database
+    gui = receiver.gui
+
     # Go through the packet list
-    for packet in packet_list:
+    try:
+        for packet in packet_list:
 
-        if not packet.in_spec():
-            logging.error("%s is not a WAPS Image Packet", packet.packet_name)
-            continue
-        if packet.is_waps_image_packet:
-            status_message = receiver.get_status()
-            logging.info(status_message)
-            logging.info(str(packet))
-        else:
-            # Log not relevant BIOLAB TM packets only in DEBUG mode
-            status_message = receiver.get_status()
-            logging.debug(status_message)
-            logging.debug(str(packet))
-
-        # Get index of the ECs in
-        ec_i = receiver.get_ec_states_index(packet.ec_address)
-
-        # Check the last writting memory slot
-        last_mem_slot = packet.biolab_current_image_memory_slot
-        if (biolab_memory_slot_change_detection and
-                receiver.ec_states[ec_i]["last_memory_slot"] != last_mem_slot):
-            status_message = receiver.get_status()
-            logging.info(status_message)
-            logging.info('  Update of active Memory slot %i Previous: %s',
-                         last_mem_slot,
-                         str(receiver.ec_states[ec_i]["last_memory_slot"]))
-            for i, image in enumerate(incomplete_images):
-                if image.memory_slot == last_mem_slot and image.ec_address == packet.ec_address:
-                    incomplete_images[i].overwritten = True
-                    receiver.database.update_image_status(incomplete_images[i])
-                    logging.warning(' Incomplete image %s has been overwritten', image.image_name)
-                    incomplete_images = receiver.remove_overwritten_image(i)
-            receiver.ec_states[ec_i]["last_memory_slot"] = last_mem_slot
-            # Update all previous database entries in this memory slot as overwritten
-            receiver.database.update_overwritten_images(packet)
-
-        # Process the packet according to Generic TM ID (packet.data[84])
-        # Only TM IDs of interest processed
-
-        # Image initialization packet
-        if packet.generic_tm_id in (0x4100, 0x5100):
-            # Generic TM ID 0x4100, Generic TM Type set
-            # with corresponding Picture ID, 0 to 7, and Packet ID to 0x000
-
-            # Track whether image is being trasmitted
-            receiver.ec_states[ec_i]["transmission_active"] = True
-
-            if packet.tm_packet_id != 0:
-                logging.warning('%s Packet ID is not zero: %i',
-                                packet.packet_name,
-                                packet.tm_packet_id)
-
-            # Create an image with the above data
-            new_image = waps_image.WapsImage(packet)
-            new_image.ec_position = receiver.get_ec_position(new_image.ec_address)
-
-            # Check for a duplicate image
-            duplicate_image = False
-            new_pkt_num = new_image.number_of_packets
-            for index, image in enumerate(incomplete_images):
-                if (image.ec_address == new_image.ec_address and
-                        image.camera_type == new_image.camera_type and
-                        image.memory_slot == new_image.memory_slot and
-                        image.number_of_packets == new_pkt_num and
-                        image.time_tag == new_image.time_tag):
-                    logging.warning(' Duplicated image detected')
-                    duplicate_image = True
-                elif (image.ec_address == new_image.ec_address and
-                        image.memory_slot == new_image.memory_slot):
-                    incomplete_images[index].overwritten = True
-                    logging.warning(' Memory slot %i of EC %i has been overwritten',
-                                    image.memory_slot, packet.ec_address)
-                    incomplete_images = receiver.remove_overwritten_image(index)
-
-            if duplicate_image:
-                continue
+            # A failing packet must not take the rest of the list with it
+            try:
+                if not packet.in_spec():
+                    logging.error("%s is not a WAPS Image Packet", packet.packet_name)
+                    continue
+                ec_address = packet.ec_address
+                is_waps_image_packet = packet.is_waps_image_packet
+
+                # Status message is only formatted if it is going to be logged
+                if is_waps_image_packet:
+                    if log_info:
+                        logging.info(receiver.get_status())
+                        logging.info('%s', packet)
+                elif log_debug:
+                    # Log not relevant BIOLAB TM packets only in DEBUG mode
+                    logging.debug(receiver.get_status())
+                    logging.debug('%s', packet)
+
+                # EC state entry of this packet, looked up once
+                ec_state = receiver.ec_states[receiver.get_ec_states_index(ec_address)]
+
+                # Check the last writting memory slot
+                last_mem_slot = packet.biolab_current_image_memory_slot
+                if (biolab_memory_slot_change_detection and
+                        ec_state["last_memory_slot"] != last_mem_slot):
+                    if log_info:
+                        logging.info(receiver.get_status())
+                    logging.info('  Update of active Memory slot %i Previous: %s',
+                                 last_mem_slot,
+                                 str(ec_state["last_memory_slot"]))
+                    overwritten_images = slot_images.get((ec_address, last_mem_slot), [])
+                    for image in list(overwritten_images):
+                        image.overwritten = True
+                        database.update_image_status(image, commit=False)
+                        logging.warning(' Incomplete image %s has been overwritten', image.image_name)
+                        incomplete_images = receiver.remove_overwritten_image(incomplete_images.index(image))
+                        slot_images.clear()
+                        slot_images.update(index_images_by_memory_slot(incomplete_images))
+                    ec_state["last_memory_slot"] = last_mem_slot
+                    # Update all previous database entries in this memory slot as overwritten
+                    database.update_overwritten_images(packet, commit=False)
+
+                # Process the packet according to Generic TM ID (packet.data[84])
+                # Only TM IDs of interest processed, other BIOLAB TM by default
+                tm_id_processor = TM_ID_PROCESSORS.get(packet.generic_tm_id, process_biolab_packet)
+                incomplete_images, duplicate = tm_id_processor(packet, packet_list, incomplete_images,
+                                                               slot_images, receiver, ec_state)
+                if duplicate:
+                    continue
+
+                if is_waps_image_packet:
+
+                    # Increase total WAPS packet count
+                    receiver.total_waps_image_packets = receiver.total_waps_image_packets + 1
+
+                    # Add packet to the database
+                    database.add_packet(packet, commit=False)
+
+                if gui:
+                    gui.update_stats()
+
+            except Exception as err:
+                logging.error('%s could not be sorted: %s', packet.packet_name, str(err))
+                receiver.unexpected_error_count = receiver.unexpected_error_count + 1
+                # The image index may be halfway through an update
+                slot_images.clear()
+                slot_images.update(index_images_by_memory_slot(incomplete_images))
+
+    finally:
+        # All database changes of this packet list in a single transaction,
+        # also those done before an unexpected stop
+        database.commit()
+
+    return incomplete_images
+
+
+def process_init_packet(packet, packet_list, incomplete_images, slot_images, receiver, ec_state):
+    """Process a WAPS image initialization packet (Generic TM ID 0x4100 and 0x5100)
+    Create a new image, unless it is a duplicate, add it to the database and active image list
+
+    Args:
+        packet (WapsPacket type): image initialization packet
+        packet_list (list): packets being sorted
+        incomplete_images (list): list of active (incomplete) images
+        slot_images (dict): active images indexed by EC address and memory slot
+        receiver (Receiver type): current waps_ies.Receiver instance
+        ec_state (dict): ec_states entry of the packet EC
+
+    Returns:
+        incomplete_images (list): list of active (incomplete) images
+        duplicate (bool): whether the packet is a duplicate to be dropped
+    """
 
-            # Add image to the database
-            uuid = receiver.database.add_image(new_image)
-
-            # Update packet's image uuid
-            packet.image_uuid = uuid
-
-            # If image already exists in database - skip
-            if uuid == new_image.uuid:
-                receiver.total_initialized_images = receiver.total_initialized_images + 1
-                logging.info('  New %s image in Memory slot %i with %i packets',
-                             new_image.image_name,
-                             packet.image_memory_slot,
-                             new_image.number_of_packets)
-
-                # Check database for existing packets
-                existing_packet_list = receiver.database.retrieve_packets_after(packet)
-                if len(existing_packet_list) != 0:
-                    # Update all packets with this image uuid
-                    for index, existing_packet in enumerate(existing_packet_list):
-                        # Since image_uuid of the packet is changed, make sure the previous image is updated too.
-                        if (existing_packet.image_uuid is not None and
-                                existing_packet.image_uuid not in receiver.recover_image_uuids):
-                            receiver.recover_image_uuids.append(existing_packet_list[index].image_uuid)
-                        existing_packet_list[index].image_uuid = new_image.uuid
-                        receiver.database.update_image_uuid_of_a_packet(existing_packet)
-                        new_image.add_packet(existing_packet)
-
-                # Add image to the incomplete list
-                incomplete_images.append(new_image)
-
-            receiver.database.update_image_status(new_image)
-
-            # Update all previous database entries in this memory slot as overwritten
-            receiver.database.update_overwritten_images(packet)
-
-            # On creation of a new image assign a GUI column
-            if receiver.gui:
-                receiver.assign_ec_column(new_image.ec_address)
-
-        # Image data packet
-        elif packet.generic_tm_id in (0x4200, 0x5200):
-            # Generic TM ID 0x4200, Generic TM Type set
-            # with corresponding Picture ID, 0 to 7, and
-            # Packet ID is incremented
-
-            # Track whether image is being trasmitted
-            receiver.ec_states[ec_i]["transmission_active"] = True
-
-            # Search through incomplete images, matching image_memory_slot
-            found_matching_image = False
-            for i, image in enumerate(incomplete_images):
-                if (image.ec_address == packet.ec_address and
-                        image.memory_slot == packet.image_memory_slot and
-                        (not image.overwritten or packet.ccsds_time < image.last_update)):
-                    found_matching_image = True
-
-                    packet.image_uuid = incomplete_images[i].uuid
-                    incomplete_images[i].add_packet(packet)
-                    incomplete_images[i].update = True
-                    receiver.database.update_image_status(incomplete_images[i])
-                    break
-
-            # Check database for a pre-existing image
-            if not found_matching_image:
-                old_image = receiver.database.retrieve_image_from_packet(packet)
-
-                if old_image is not None:
-                    found_matching_image = True
-
-                    packet.image_uuid = old_image.uuid
-                    old_image.add_packet(packet)
-                    old_image.update = True
-                    incomplete_images.append(old_image)
-                    logging.info(" Loaded image %s from database to active memory",
-                                 old_image.image_name)
-
-            if not found_matching_image:
-                logging.error('%s matching image in memory slot %i not found',
-                              packet.packet_name,
-                              packet.image_memory_slot)
-                logging.info(" Forging a placeholder image")
-                forged_init_packet = receiver.forge_init_packet(packet)
-                packet_list.append(forged_init_packet)
+    # Generic TM ID 0x4100, Generic TM Type set
+    # with corresponding Picture ID, 0 to 7, and Packet ID to 0x000
 
+    # Track whether image is being trasmitted
+    ec_state["transmission_active"] = True
+
+    if packet.tm_packet_id != 0:
+        logging.warning('%s Packet ID is not zero: %i',
+                        packet.packet_name,
+                        packet.tm_packet_id)
+
+    # Create an image with the above data
+    new_image = waps_image.WapsImage(packet)
+    new_image.ec_position = receiver.get_ec_position(new_image.ec_address)
+
+    # Check for a duplicate image
+    duplicate_image = False
+    new_image_slot = (new_image.ec_address, new_image.memory_slot)
+    for image in list(slot_images.get(new_image_slot, [])):
+        if image.duplicate_key == new_image.duplicate_key:
+            logging.warning(' Duplicated image detected')
+            duplicate_image = True
         else:
-            if receiver.ec_states[ec_i]["transmission_active"]:
-                # An image is sent in one telemetry sequence
-                # Each single packet request triggers this change as well
-                # Status information after all of the processing
-                status_message = receiver.get_status()
-                logging.info(status_message)
-                logging.info(' End of image transmission (EC addr %i)',
-                             packet.ec_address)
+            image.overwritten = True
+            logging.warning(' Memory slot %i of EC %i has been overwritten',
+                            image.memory_slot, packet.ec_address)
+            incomplete_images = receiver.remove_overwritten_image(incomplete_images.index(image))
+            slot_images.clear()
+            slot_images.update(index_images_by_memory_slot(incomplete_images))
+
+    if duplicate_image:
+        return incomplete_images, True
+
+    # Add image to the database
+    uuid = receiver.database.add_image(new_image, commit=False)
+
+    # Update packet's image uuid
+    packet.image_uuid = uuid
+
+    # If image already exists in database - skip
+    if uuid == new_image.uuid:
+        receiver.total_initialized_images = receiver.total_initialized_images + 1
+        logging.info('  New %s image in Memory slot %i with %i packets',
+                     new_image.image_name,
+                     packet.image_memory_slot,
+                     new_image.number_of_packets)
+
+        # Check database for existing packets
+        existing_packet_list = receiver.database.retrieve_packets_after(packet)
+        if len(existing_packet_list) != 0:
+            # Update all packets with this image uuid
+            for existing_packet in existing_packet_list:
+                # Since image_uuid of the packet is changed, make sure the previous image is updated too.
+                if existing_packet.image_uuid is not None:
+                    receiver.recover_image_uuids.add(existing_packet.image_uuid)
+                existing_packet.image_uuid = new_image.uuid
+                receiver.database.update_image_uuid_of_a_packet(existing_packet, commit=False)
+                new_image.add_packet(existing_packet)
+
+        # Add image to the incomplete list
+        incomplete_images.append(new_image)
+        slot_images.setdefault(new_image_slot, []).append(new_image)
+
+    receiver.database.update_image_status(new_image, commit=False)
+
+    # Update all previous database entries in this memory slot as overwritten
+    receiver.database.update_overwritten_images(packet, commit=False)
+
+    # On creation of a new image assign a GUI column
+    if receiver.gui:
+        receiver.assign_ec_column(new_image.ec_address)
+
+    return incomplete_images, False
+
+
+def process_data_packet(packet, packet_list, incomplete_images, slot_images, receiver, ec_state):
+    """Process a WAPS image data packet (Generic TM ID 0x4200 and 0x5200)
+    Add the packet to the matching active image or the one in the database.
+    Forge an initialization packet if there is none.
+
+    Args:
+        packet (WapsPacket type): image data packet
+        packet_list (list): packets being sorted, forged packets are appended
+        incomplete_images (list): list of active (incomplete) images
+        slot_images (dict): active images indexed by EC address and memory slot
+        receiver (Receiver type): current waps_ies.Receiver instance
+        ec_state (dict): ec_states entry of the packet EC
+
+    Returns:
+        incomplete_images (list): list of active (incomplete) images
+        duplicate (bool): always False
+    """
 
-                # Go through incomplete images and
-                # mark that transmission is finished
-                for i, image in enumerate(incomplete_images):
-                    if image.image_transmission_active and image.ec_address == packet.ec_address:
-                        incomplete_images[i].image_transmission_active = False
-                        incomplete_images[i].update = True
-                        receiver.database.update_image_status(incomplete_images[i])
+    # Generic TM ID 0x4200, Generic TM Type set
+    # with corresponding Picture ID, 0 to 7, and
+    # Packet ID is incremented
 
-                # Reset transmission status
-                receiver.ec_states[ec_i]["transmission_active"] = False
+    # Track whether image is being trasmitted
+    ec_state["transmission_active"] = True
 
-        if packet.is_waps_image_packet:
+    # Search through incomplete images, matching image_memory_slot
+    found_matching_image = False
+    packet_slot = (packet.ec_address, packet.image_memory_slot)
+    for image in slot_images.get(packet_slot, []):
+        if not image.overwritten or packet.ccsds_time < image.last_update:
+            found_matching_image = True
 
-            # Increase total WAPS packet count
-            receiver.total_waps_image_packets = receiver.total_waps_image_packets + 1
+            packet.image_uuid = image.uuid
+            image.add_packet(packet)
+            image.update = True
+            receiver.database.update_image_status(image, commit=False)
+            break
 
-            # Add packet to the database
-            receiver.database.add_packet(packet)
+    # Check database for a pre-existing image
+    if not found_matching_image:
+        old_image = receiver.database.retrieve_image_from_packet(packet)
 
-        if receiver.gui:
-            receiver.gui.update_stats()
+        if old_image is not None:
+            found_matching_image = True
 
-    return incomplete_images
+            packet.image_uuid = old_image.uuid
+            old_image.add_packet(packet)
+            old_image.update = True
+            incomplete_images.append(old_image)
+            slot_images.setdefault(packet_slot, []).append(old_image)
+            logging.info(" Loaded image %s from database to active memory",
+                         old_image.image_name)
+
+    if not found_matching_image:
+        logging.error('%s matching image in memory slot %i not found',
+                      packet.packet_name,
+                      packet.image_memory_slot)
+        logging.info(" Forging a placeholder image")
+        forged_init_packet = receiver.forge_init_packet(packet)
+        packet_list.append(forged_init_packet)
+
+    return incomplete_images, False
+
+
+def process_biolab_packet(packet, packet_list, incomplete_images, slot_images, receiver, ec_state):
+    """Process any other BIOLAB TM packet
+    The first one after WAPS image packets marks the end of image transmission
 
+    Args:
+        packet (WapsPacket type): BIOLAB TM packet
+        packet_list (list): packets being sorted
+        incomplete_images (list): list of active (incomplete) images
+        slot_images (dict): active images indexed by EC address and memory slot
+        receiver (Receiver type): current waps_ies.Receiver instance
+        ec_state (dict): ec_states entry of the packet EC
+
+    Returns:
+        incomplete_images (list): list of active (incomplete) images
+        duplicate (bool): always False
+    """
+
+    if ec_state["transmission_active"]:
+        # An image is sent in one telemetry sequence
+        # Each single packet request triggers this change as well
+        # Status information after all of the processing
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info(receiver.get_status())
+        logging.info(' End of image transmission (EC addr %i)',
+                     packet.ec_address)
 
-def write_file(image_data, file_path, filetype='wb', gui=None):
+        # Go through incomplete images and
+        # mark that transmission is finished
+        for image in incomplete_images:
+            if image.image_transmission_active and image.ec_address == packet.ec_address:
+                image.image_transmission_active = False
+                image.update = True
+                receiver.database.update_image_status(image, commit=False)
+
+        # Reset transmission status
+        ec_state["transmission_active"] = False
+
+    return incomplete_images, False
+
+
+# Packet processing according to Generic TM ID
+TM_ID_PROCESSORS = {0x4100: process_init_packet,
+                    0x5100: process_init_packet,
+                    0x4200: process_data_packet,
+                    0x5200: process_data_packet}
+
+
+def write_file(image_data, file_path, filetype='wb', known_previous=None, known_digest=None):
     """Write image to the output path
+    See write_file_with_digest
+
+    Args:
+        image_data (data array): binary data or string data depending on the file format
+        file_path (str): file path where to save the file
+        filetype (str): binary ('wb') or text ('w') data
+        known_previous (str): previously saved file of the same image
+        known_digest (tuple): file digest of known_previous
+
+    Returns:
+        file_path (str): Actual written file
+                         None if could not write the file
+    """
+
+    return write_file_with_digest(image_data, file_path, filetype,
+                                  known_previous, known_digest)[0]
+
+
+def write_file_with_digest(image_data, file_path, filetype='wb',
+                           known_previous=None, known_digest=None):
+    """Write image to the output path and get the digest of the written file
     Before writing check existence of an identical file or filename.
-    Change filename if already exists
+    Existing files are only read back for comparison if the size matches.
+    Text is encoded once with platform line endings and written in binary mode.
+    Change filename if already exists.
+    The previous save of the same image (known_previous) is not written again
+    if its file digest (content digest, size and modification time) is unchanged,
+    otherwise it is overwritten without comparison.
+    The file is written to a temporary file first and then renamed in place.
 
     Args:
         image_data (data array): binary data or string data depending on the file format
         file_path (str): file path where to save the file
-        filetype (str): binary or text file
-        gui (gui type): for latest written file name update
+        filetype (str): binary ('wb') or text ('w') data
+        known_previous (str): previously saved file of the same image
+        known_digest (tuple): file digest of known_previous
 
     Returns:
         file_path (str): Actual written file
                          None if could not write the file
+        file_digest (tuple): content digest, size and modification time of the file
+                             None if could not write the file
     """
 
-    readtype = 'rb'
+    # Text is encoded once with platform line endings, same as a text mode write,
+    # from here on all files are handled as binary data
     if filetype == 'w':
-        readtype = 'r'
+        image_data = image_data.replace('\n', os.linesep).encode()
+    digest = hashlib.blake2b(image_data, digest_size=16).digest()
 
     # Check existing file
     try:
-        version_number = 2
-        while os.path.exists(file_path):
-            with open(file_path, readtype) as file:
-                file_data = file.read()
-                exists = " exists already "
-                if file_data == image_data:
-                    logging.info('File %s%s and is identical. %s',
-                                 file_path,
-                                 exists,
-                                 "No need to overwrite.")
-                    return file_path
-                logging.info('File %s%s but contents is different',
+        # The previous save is trusted only if the file on disk has not changed since
+        if file_path == known_previous and known_digest is not None:
+            file_stat = os.stat(file_path)
+            if known_digest == (digest, file_stat.st_size, file_stat.st_mtime_ns):
+                logging.info('File %s is identical to the previous save. %s',
                              file_path,
-                             exists)
-                # Change file name to indicate new version
-                file_path = (file_path[:file_path.rfind('.')] + 'v' +
-                             str(version_number) +
-                             file_path[file_path.rfind('.'):])
+                             "No need to overwrite.")
+                return file_path, known_digest
+
+        file_path_base, file_extension = os.path.splitext(file_path)
+        version_number = 2
+        while file_path != known_previous and os.path.exists(file_path):
+            exists = " exists already "
+            # A binary file of a different size cannot be identical, no need to read it
+            if os.path.getsize(file_path) == len(image_data):
+                with open(file_path, 'rb') as file:
+                    file_data = file.read()
+                    if file_data == image_data:
+                        logging.info('File %s%s and is identical. %s',
+                                     file_path,
+                                     exists,
+                                     "No need to overwrite.")
+                        file_stat = os.stat(file_path)
+                        return file_path, (digest, file_stat.st_size, file_stat.st_mtime_ns)
+            logging.info('File %s%s but contents is different',
+                         file_path,
+                         exists)
+            # Change file name to indicate new version
+            file_path = file_path_base + 'v' + str(version_number) + file_extension
+            version_number = version_number + 1
 
     except IOError:
         pass
 
     # Write the file
     try:
-        with open(file_path, filetype) as file:
+        with open(file_path + '.tmp', 'wb') as file:
             file.write(image_data)
-            logging.info("Saved file: %s", str(file_path))
-            if gui:
-                file_name = file_path[file_path.rfind('/')-8:]
-                gui.update_latets_file(file_name)
+        os.replace(file_path + '.tmp', file_path)
+        file_stat = os.stat(file_path)
+        logging.info("Saved file: %s", file_path)
 
     except IOError:
         logging.error('Could not open file for writing: %s', file_path)
-        return None
+        # Do not leave the temporary file behind
+        try:
+            if os.path.exists(file_path + '.tmp'):
+                os.remove(file_path + '.tmp')
+        except IOError:
+            logging.warning('Could not remove temporary file %s.tmp', file_path)
+        return None, None
 
     # Successful write
-    return file_path
+    return file_path, (digest, file_stat.st_size, file_stat.st_mtime_ns)
 
 
 def print_images_status(images):
@@ -326,16 +516,36 @@ def print_images_status(images):
     """
 
     for image in images:
-        missing_packets = image.get_missing_packets()
-        completeness_message = ('Image %s is %s complete' %
-                                (image.image_name,
-                                 image.get_completeness_str()))
-        if len(missing_packets) > 0:
-            completeness_message = (completeness_message +
-                                    '. Missing packets: ' +
-                                    image.missing_packets_string())
+        log_image_completeness(image, image.get_missing_packets())
+
+
+def log_image_completeness(image, missing_packets, level=logging.INFO,
+                           completeness_str=None):
+    """Logs completeness of a single image
+    Missing packets are listed only if there are any
 
-        logging.info(completeness_message)
+    Args:
+        image (WapsImage type): image for completeness status message
+        missing_packets (list): already retrieved missing packet list of the image
+        level (int): logging level of the message
+        completeness_str (str): already formatted completeness string, optional
+    """
+
+    if not logging.getLogger().isEnabledFor(level):
+        return
+
+    if completeness_str is None:
+        completeness_str = image.get_completeness_str(missing_packets)
+
+    if len(missing_packets) > 0:
+        logging.log(level, 'Image %s is %s complete. Missing packets: %s',
+                    image.image_name,
+                    completeness_str,
+                    image.missing_packets_string(missing_packets=missing_packets))
+    else:
+        logging.log(level, 'Image %s is %s complete',
+                    image.image_name,
+                    completeness_str)
 
 
 def create_command_stack(image, receiver):
@@ -355,79 +565,32 @@ def create_command_stack(image, receiver):
         ec_position = '.EC_XX'
     missing_packets = image.get_missing_packets()
 
-    # Start of the Yamcs command stack
-    data = '''{
-  "$schema": "https://yamcs.org/schema/command-stack.schema.json",
-  "advancement": {
-    "wait": 0
-  },
-  "commands": [\n'''
-
-    # Add a section of parameters per missing packet
-    for i, packet in enumerate(missing_packets):
-        data = data + '''    {
-      "namespace": "MDB:OPS Name",
-      "name": "Biolab_Cmd_EC_Send_Message",
-      "arguments": [
-        {
-          "name": "timeTag_0xYYYYMMDD",
-          "value": "-1"
-        },
-        {
-          "name": "timeTag_0xhhmmss00",
-          "value": "-1"
-        },
-        {
-          "name": "ECName",
-          "value": "'''
-        data = data + ec_position
-        data = data + '''"
-        },
-        {
-          "name": "dataInFile",
-          "value": "0"
-        },
-        {
-          "name": "returnAnswer",
-          "value": "0"
-        },
-        {
-          "name": "recordAnswerTo",
-          "value": "0"
-        },
-        {
-          "name": "data",
-          "value": "40F3'''
-        data = data + f'{((image.memory_slot << 12) + packet):04X}'
-        data = data + '''"\n        },
-        {
-          "name": "ph-ack-acceptance",
-          "value": "True"
-        },
-        {
-          "name": "ph-ack-exec-start",
-          "value": "True"
-        }
-      ],
-      "advancement": {\n'''
-        data = data + f'        "wait": {command_delay}\n'
-        data = data + '''      }
-    }'''
-
-        if len(missing_packets)-1 != i:
-            data = data + ','
-        data = data + '\n'
-
-    # End of the command stack
-    data = data + '''  ]
-}'''
+    # Yamcs command stack with a section of parameters per missing packet
+    command_stack = {
+        "$schema": "https://yamcs.org/schema/command-stack.schema.json",
+        "advancement": {"wait": 0},
+        "commands": [{"namespace": "MDB:OPS Name",
+                      "name": "Biolab_Cmd_EC_Send_Message",
+                      "arguments": [{"name": "timeTag_0xYYYYMMDD", "value": "-1"},
+                                    {"name": "timeTag_0xhhmmss00", "value": "-1"},
+                                    {"name": "ECName", "value": ec_position},
+                                    {"name": "dataInFile", "value": "0"},
+                                    {"name": "returnAnswer", "value": "0"},
+                                    {"name": "recordAnswerTo", "value": "0"},
+                                    {"name": "data",
+                                     "value": f'40F3{((image.memory_slot << 12) + packet):04X}'},
+                                    {"name": "ph-ack-acceptance", "value": "True"},
+                                    {"name": "ph-ack-exec-start", "value": "True"}],
+                      "advancement": {"wait": command_delay}}
+                     for packet in missing_packets]}
 
     file_path = (receiver.comm_path + f"{ec_position[1:]}_{image.ec_address}_m{image.memory_slot}_" +
                  image.last_update.strftime('%Y-%m-%d_%H%M%S') + ".ycs")
 
     try:
         with open(file_path, 'w') as file:
-            file.write(data)
+            # Encoded and written to the file piece by piece
+            json.dump(command_stack, file, indent=2)
             logging.info("Created Yamcs command stack for %s %i m%i with %i missing packets: %s",
                          ec_position, image.ec_address, image.memory_slot, len(missing_packets),
                          file_path)
@@ -435,6 +598,33 @@ def create_command_stack(image, receiver):
         logging.error('Could not open file for writing: %s', file_path)
 
 
+def get_file_write_result(file_write, image, receiver):
+    """Wait for a file write of an image
+    A failed write is logged and counted as an unexpected error
+
+    Args:
+        file_write (Future type): submitted write_file_with_digest call, or None
+        image (WapsImage type): image the file belongs to
+        receiver (Receiver type): current waps_ies.Receiver instance
+
+    Returns:
+        file_path (str): Actual written file
+                         None if not written
+        file_digest (tuple): content digest, size and modification time of the file
+                             None if not written
+    """
+
+    if file_write is None:
+        return None, None
+
+    try:
+        return file_write.result()
+    except Exception as err:
+        logging.error('%s file write failed: %s', image.image_name, str(err))
+        receiver.unexpected_error_count = receiver.unexpected_error_count + 1
+        return None, None
+
+
 def save_images(images, output_path, receiver, save_incomplete=True):
     """ Reconstruct and save images to files
     For each image in the list
@@ -449,6 +639,8 @@ def save_images(images, output_path, receiver, save_incomplete=True):
     5. On successful reconstruction remove previous file version(s)
     6. Update gui with image status
     7. Remove completed images from active image list
+    Files of all images are written in parallel by the receiver file write executor,
+    steps 5 and 6 are done once all the files are written.
 
     Args:
         images (list): list of active (incomplete) images
@@ -460,28 +652,38 @@ def save_images(images, output_path, receiver, save_incomplete=True):
         images (list): list of active (incomplete) images
     """
 
+    # Ignore images if there is no update on them
+    updated_images = [(index, image) for index, image in enumerate(images) if image.update]
+    if len(updated_images) == 0:
+        return images
+
     gui = receiver.gui
     finished_images = []
+    image_file_writes = []
+    # Images to update in the database, in one statement per table
+    status_images = []
+    filename_images = []
+    date_paths = set()
 
-    for index, image in enumerate(images):
-
-        # Make sure folder with today's path exists
-        date_path = output_path + image.ccsds_time.strftime('%Y%m%d') + '/'
-        if (not os.path.exists(date_path) or
-                not os.path.isdir(date_path)):
-            if not os.path.exists(output_path):
-                os.mkdir(output_path)
-            os.mkdir(date_path)
-
-        successful_write = False
+    for index, image in updated_images:
 
-        # Ignore if there is no update on the image
-        if not image.update:
-            continue
+        # Make sure folder with today's path exists, once per date
+        date_path = os.path.join(output_path, image.ccsds_time.strftime('%Y%m%d'))
+        if date_path not in date_paths:
+            os.makedirs(date_path, exist_ok=True)
+            date_paths.add(date_path)
 
         # Get number of packets associated with this image
         image.total_packets = receiver.database.get_image_packet_number(image.uuid)
 
+        # Nothing to reconstruct without any expected packets
+        if image.number_of_packets <= 0:
+            logging.warning('%s has no expected packets, not saved',
+                            image.image_name)
+            image.update = False
+            status_images.append(image)
+            continue
+
         # Update gui if available
         if gui:
             gui.update_image_data(image)
@@ -493,28 +695,44 @@ def save_images(images, output_path, receiver, save_incomplete=True):
             image.update = False
             continue
 
+        # Skip images saved already from the same packets and transmission state
+        saved_state = (image.number_of_packets,
+                       image.image_transmission_active,
+                       tuple(image.get_missing_packets()),
+                       tuple(image.get_missing_packets(True)))
+        # Saved files deleted or moved since are written again
+        if (image.latest_saved_file is not None and image.saved_state == saved_state and
+                all(os.path.exists(saved_file)
+                    for saved_file in (image.latest_saved_file,
+                                       image.latest_saved_file_tm,
+                                       image.latest_saved_file_data)
+                    if saved_file is not None)):
+            logging.debug('%s has no changes since the latest saved file',
+                          image.image_name)
+            image.update = False
+            status_images.append(image)
+            continue
+
         # Get image binary data first
         image_data = image.reconstruct()
         # Add completion percentage to the file name
         missing_packets = image.get_missing_packets()
-        completeness_str = image.get_completeness_str()
+        # Same as image.is_complete() with the above missing packet list
+        image_complete = image.know_number_of_packets and len(missing_packets) == 0
+        completeness_str = image.get_completeness_str(missing_packets)
         image_percentage = '_' + completeness_str[:completeness_str.find('%')]
-        completeness_message = ('Image %s is %s complete' %
-                                (image.image_name,
-                                 completeness_str))
-        if len(missing_packets) > 0:
-            completeness_message = (completeness_message +
-                                    '. Missing packets: ' +
-                                    image.missing_packets_string())
-
-        if len(missing_packets) == 0 or image.image_transmission_active:
-            logging.info(completeness_message)
-        else:
-            logging.warning(completeness_message)
+
+        # Incomplete image after transmission is a warning
+        completeness_level = logging.INFO
+        if len(missing_packets) > 0 and not image.image_transmission_active:
+            completeness_level = logging.WARNING
+        log_image_completeness(image, missing_packets, completeness_level,
+                               completeness_str)
 
         if len(missing_packets) == 0:
             image.image_transmission_active = False
-            if image.latest_saved_file is None or image.latest_saved_file[-7:-4] != '100':
+            if (image.latest_saved_file is None or
+                    not os.path.splitext(image.latest_saved_file)[0].endswith('100')):
                 receiver.total_completed_images = receiver.total_completed_images + 1
 
         if image.latest_saved_file is None:  # Only after the initial image transmission
@@ -526,12 +744,14 @@ def save_images(images, output_path, receiver, save_incomplete=True):
                 # Create command stack for missing packets
                 create_command_stack(image, receiver)
 
-        # Print detailed image information
-        logging.info(image)
+        # Print detailed image information (only formatted when logged)
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info('%s', image)
 
-        written_image_file_path = None
-        written_image_tm_file_path = None
-        written_image_data_file_path = None
+        # Image, FLIR telemetry and FLIR data file writes
+        image_file_write = None
+        tm_file_write = None
+        data_file_write = None
 
         # Handle if EC position is missing
         position = image.ec_position
@@ -539,27 +759,22 @@ def save_images(images, output_path, receiver, save_incomplete=True):
             position = '.EC_XX'
 
         # File anme base for any file type
-        file_path_base = date_path + position[1:] + '_' + image.image_name[3:] + image_percentage
+        file_path_base = os.path.join(date_path,
+                                      position[1:] + '_' + image.image_name[3:] + image_percentage)
 
         # Now save the image to file(s)
         if image.camera_type == 'uCAM':
             # Sanity check the data
-            if (image_data[0] != 0xFF or
-                    image_data[1] != 0xD8 or
-                    image_data[2] != 0xFF or
-                    image_data[3] != 0xDB):
+            if not image_data.startswith(UCAM_JPEG_HEADER):
                 logging.warning('%s does not have a .JPG header',
                                 image.image_name)
 
             # Image data is saved as is, binary
             file_path = file_path_base + '.jpg'
 
-            written_image_file_path = write_file(image_data, file_path, 'wb', gui)
-
-            if written_image_file_path is not None:
-                successful_write = True
-            if image.is_complete() and successful_write:
-                finished_images.append(index)
+            image_file_write = receiver.file_write_executor.submit(
+                write_file_with_digest, image_data, file_path, 'wb',
+                image.latest_saved_file, image.latest_saved_file_digest)
 
         elif image.camera_type == 'FLIR':
             # TM data is first 480 bytes, then 9600 bytes of data
@@ -573,128 +788,125 @@ def save_images(images, output_path, receiver, save_incomplete=True):
             # FLIR telemetry data is saved into a text file
             file_path_tm = file_path_base + '_tm.txt'
 
-            tm_image_data = ""
-            for i in range(int(tm_length/2)):
-                if i < 80:
-                    tm_image_data = tm_image_data + 'A'
-                elif 160 > i >= 80:
-                    tm_image_data = tm_image_data + 'B'
-                else:
-                    tm_image_data = tm_image_data + 'C'
-                tm_image_data = (tm_image_data + str(i % 80) + ':' +
-                                 str(unpack('>H', image_data[i*2:i*2+2])[0]) +
-                                 '\n')
-
-            written_image_tm_file_path = write_file(tm_image_data,
-                                                    file_path_tm,
-                                                    'w',
-                                                    gui)
+            tm_values = FLIR_TM_VALUES.unpack_from(image_data)
+            # 80 values per each of A, B and C blocks
+            tm_image_data = ''.join([label + str(value) + '\n'
+                                     for label, value in zip(FLIR_TM_LABELS, tm_values)])
+
+            tm_file_write = receiver.file_write_executor.submit(
+                write_file_with_digest, tm_image_data, file_path_tm, 'w',
+                image.latest_saved_file_tm, image.latest_saved_file_tm_digest)
 
             # FLIR Image data is converted to .csv file
             file_path_csv = file_path_base + '_data.csv'
 
-            csv_image_data = str(unpack('>H',
-                                 image_data[tm_length:tm_length+2])[0])
-            for i in range(1, int((len(image_data)-tm_length)/2)):
-                if i % 80:  # 80 values in one row
-                    csv_image_data = csv_image_data + ','
-                else:
-                    csv_image_data = csv_image_data + '\n'
-                val = tm_length+i*2
-                csv_image_data = (csv_image_data +
-                                  str(unpack('>H', image_data[val:val+2])[0]))
-            csv_image_data = csv_image_data + '\n'
-
-            written_image_data_file_path = write_file(csv_image_data,
-                                                      file_path_csv,
-                                                      'w',
-                                                      gui)
+            # All pixels are decoded in a single call, straight from the image buffer
+            pixel_count = (len(image_data)-tm_length)//2
+            array_image_data = unpack_from('>' + str(pixel_count) + 'H',
+                                           image_data, tm_length)
+
+            # 80 values in one row
+            csv_image_data = '\n'.join([','.join(map(str, array_image_data[i:i+80]))
+                                        for i in range(0, pixel_count, 80)]) + '\n'
+
+            data_file_write = receiver.file_write_executor.submit(
+                write_file_with_digest, csv_image_data, file_path_csv, 'w',
+                image.latest_saved_file_data, image.latest_saved_file_data_digest)
 
             # FLIR Image data is converted is saved as .bmp file
             file_path = file_path_base + '.bmp'
 
             # Structure BMP image data
-            array_image_data = []
-            bmp_image_data = []
-            for i in range(int((len(image_data)-tm_length)/2)):
-                val = tm_length+i*2
-                pixel = unpack('>H', image_data[val:val+2])[0]
-                array_image_data.append(pixel)
             max_pixel = max(array_image_data)
             min_pixel = min(array_image_data)
             range_pixel = max_pixel - min_pixel
-            # Restructure because BMP is flipped
-            for y_i in range(60):
-                for x_i in range(80):
-                    pixel = array_image_data[(59-y_i)*80+x_i]
-                    bmp_pixel = int((pixel - min_pixel)/range_pixel*255)
-                    bmp_image_data.append(bmp_pixel)
-                    bmp_image_data.append(bmp_pixel)
-                    bmp_image_data.append(bmp_pixel)
-                    bmp_image_data.append(255)
-            bmp_image_data = bytearray(bmp_image_data)
-
-            bmp_header = (bytes("BM", 'utf-8') +
-                          pack('IHHIIIIHHIIIIII',
-                               19200 + 54,  # file size
-                               0, 0,        # reserved
-                               54,          # offset
-                               40,          # header size
-                               80,          # image width
-                               60,          # image height
-                               1,           # planes
-                               32,          # bits per pixel
-                               0, 0,        # no compression
-                               3780, 3780,  # pixel per meter
-                               0, 0))       # unused
-            bmp_data = bmp_header + bmp_image_data
-
-            written_image_file_path = write_file(bmp_data, file_path, 'wb', gui)
+            if range_pixel == 0:  # Uniform image
+                range_pixel = 1
+            # Integer scaling in a single pass, rows in reverse because BMP is flipped
+            grey_image_data = bytes([(pixel - min_pixel)*255//range_pixel
+                                     for y_i in range(59, -1, -1)
+                                     for pixel in array_image_data[y_i*80:(y_i+1)*80]])
+            # Header and pixels are written into a single preallocated buffer
+            bmp_data = bytearray(len(FLIR_BMP_HEADER) + len(grey_image_data)*4)
+            bmp_data[:len(FLIR_BMP_HEADER)] = FLIR_BMP_HEADER
+            bmp_view = memoryview(bmp_data)[len(FLIR_BMP_HEADER):]
+            # Same grey value in blue, green and red channels, opaque alpha
+            bmp_view[0::4] = grey_image_data
+            bmp_view[1::4] = grey_image_data
+            bmp_view[2::4] = grey_image_data
+            bmp_view[3::4] = b'\xff' * len(grey_image_data)
+            bmp_view.release()
+
+            image_file_write = receiver.file_write_executor.submit(
+                write_file_with_digest, bmp_data, file_path, 'wb',
+                image.latest_saved_file, image.latest_saved_file_digest)
+
+        image_file_writes.append((index, image, image_complete, saved_state,
+                                  image_file_write, tm_file_write, data_file_write))
+
+    # Wait for the files of every image to be written
+    for (index, image, image_complete, saved_state,
+         image_file_write, tm_file_write, data_file_write) in image_file_writes:
+
+        # A failed file write only affects that file
+        written_image_file_path, written_image_file_digest = get_file_write_result(
+            image_file_write, image, receiver)
+        written_image_tm_file_path, written_image_tm_file_digest = get_file_write_result(
+            tm_file_write, image, receiver)
+        written_image_data_file_path, written_image_data_file_digest = get_file_write_result(
+            data_file_write, image, receiver)
+
+        # Update gui with the latest written files, date directory and file name
+        if gui:
+            for written_file_path in (written_image_tm_file_path,
+                                      written_image_data_file_path,
+                                      written_image_file_path):
+                if written_file_path is not None:
+                    gui.update_latets_file(
+                        os.path.join(os.path.basename(os.path.dirname(written_file_path)),
+                                     os.path.basename(written_file_path)))
 
+        successful_write = False
+        if image.camera_type == 'uCAM':
+            if written_image_file_path is not None:
+                successful_write = True
+        elif image.camera_type == 'FLIR':
             if (written_image_file_path is not None and
                     written_image_tm_file_path is not None and
                     written_image_data_file_path is not None):
                 successful_write = True
-            if image.is_complete() and successful_write:
-                finished_images.append(index)
+        if image_complete and successful_write:
+            finished_images.append(index)
 
         # On a successful file write note that there are not more updates
         if successful_write:
             image.update = False
+            image.saved_state = saved_state
+
+        # Note every written file and remove its previous version
+        for saved_file, written_file_path, written_file_digest in (
+                ('latest_saved_file', written_image_file_path, written_image_file_digest),
+                ('latest_saved_file_tm', written_image_tm_file_path, written_image_tm_file_digest),
+                ('latest_saved_file_data', written_image_data_file_path,
+                 written_image_data_file_digest)):
+            if written_file_path is None:
+                continue
 
-            # Since the file write was successful,
-            # remove previous versions of the files
+            previous_file_path = getattr(image, saved_file)
             try:
-                if (image.latest_saved_file != written_image_file_path and
-                        image.latest_saved_file is not None and
-                        os.path.exists(image.latest_saved_file)):
-                    os.remove(image.latest_saved_file)
-                    logging.info('Removed previous version of file %s',
-                                 image.latest_saved_file)
-
-                if (image.latest_saved_file_tm != written_image_tm_file_path and
-                        image.latest_saved_file_tm is not None and
-                        os.path.exists(image.latest_saved_file_tm)):
-                    os.remove(image.latest_saved_file_tm)
-                    logging.info('Removed previous version of file %s',
-                                 image.latest_saved_file_tm)
-
-                if (image.latest_saved_file_data != written_image_data_file_path and
-                        image.latest_saved_file_data is not None and
-                        os.path.exists(image.latest_saved_file_data)):
-                    os.remove(image.latest_saved_file_data)
+                if (previous_file_path != written_file_path and
+                        previous_file_path is not None and
+                        os.path.exists(previous_file_path)):
+                    os.remove(previous_file_path)
                     logging.info('Removed previous version of file %s',
-                                 image.latest_saved_file_data)
+                                 previous_file_path)
 
             except IOError:
-                logging.info('Could not remove some of the old file versions')
-                pass
+                logging.info('Could not remove old file version %s', previous_file_path)
 
             # And note the latest written down file
-            image.latest_saved_file = written_image_file_path
-            if image.camera_type == "FLIR":
-                image.latest_saved_file_tm = written_image_tm_file_path
-                image.latest_saved_file_data = written_image_data_file_path
+            setattr(image, saved_file, written_file_path)
+            setattr(image, saved_file + '_digest', written_file_digest)
 
         # Update gui if available
         if gui:
@@ -703,13 +915,17 @@ def save_images(images, output_path, receiver, save_incomplete=True):
 
         # Update image in database
         image.update = False
-        receiver.database.update_image_status(image)
-        receiver.database.update_image_filenames(image)
+        status_images.append(image)
+        filename_images.append(image)
 
     # Remove fully complete and written down images from the incomplete list
     if len(finished_images) > 0:
-        for index in finished_images[::-1]:
-            receiver.database.update_image_status(images[index])
-            images.pop(index)
+        finished_set = set(finished_images)
+        images[:] = [image for i, image in enumerate(images) if i not in finished_set]
+
+    # All database changes of this image list in a single transaction
+    receiver.database.update_images_status(status_images, commit=False)
+    receiver.database.update_images_filenames(filename_images, commit=False)
+    receiver.database.commit()
 
     return images
@@ -21,6 +21,9 @@ import sys
 from datetime import datetime, timedelta
 import socket
 import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from struct import unpack
 from waps_ies import interface, processor, database, waps_packet
 
@@ -32,6 +35,13 @@ CCSDS_HEADERS_LENGTH = CCSDS1_HEADER_LENGTH + CCSDS2_HEADER_LENGTH
 # BIOLAB TM id position in CCSDS packet
 BIOLAB_ID_POSITION = 40
 
+# Maximum number of queued CCSDS packets processed together
+PACKET_BATCH_SIZE = 64
+# Maximum number of reception events waiting for the main loop
+RECEPTION_QUEUE_SIZE = 10000
+# Number of image files written in parallel, file operations release the GIL
+FILE_WRITE_WORKERS = 4
+
 
 class Receiver:
     """Receiver Class
@@ -40,6 +50,7 @@ class Receiver:
     Attributes
     ----------
     failed_connection_count (int) : number of failed connection since a successful one
+        (only used by the reception thread)
     tcp_rerequest_count (int): number of TCP rerequests needed during this IES session
     unexpected_error_count (int): Unexpected error count during this session
     previously_received_bytes (bytearray): bytes left over from an overflowed TCP reception
@@ -49,6 +60,10 @@ class Receiver:
     tcp_timeout (float): TCP reception timeout
     timeout_notified (bool): TCP timeout notification limited to one message
     connected (bool): internal indication of TCP server connection
+    packet_queue (Queue type): reception events (CCSDS packets, reception counts,
+        connection changes) waiting for the main loop
+    reception_thread (Threading type): TCP reception thread instance
+    file_write_executor (ThreadPoolExecutor type): image file writes in parallel
 
     output_path (str): output image root path
     comm_path (str): missing packet command stack path
@@ -66,10 +81,11 @@ class Receiver:
     skip_verify_code (bool): Whether to report and count verify code (2020 interface test exception)
 
     ec_states (list): List of know ECs wth addresses, positions and statuses
+    ec_states_index (dict): EC address to ec_states index lookup cache
 
     gui (window type): Graphical Interface Class Instance
     refresh_gui_list_window (bool): Indication from GUI whether to update the image gui window
-    recover_image_uuids (list): List of iamge uuids to recover from database (action from gui)
+    recover_image_uuids (set): Set of iamge uuids to recover from database (action from gui)
     clone_database (bool): condition to clone the database
 
     continue_running (bool): Main loop condition
@@ -115,6 +131,12 @@ class Receiver:
         Main loop actions before receiving CCSDS packets
     receive_ccsds_packet(self):
         CCSDS packet reception with retries
+    reception_loop(self):
+        Reception thread loop with TCP connection and CCSDS packet reception
+    post_reception_event(self, event, data=None):
+        Hand a reception event over to the main loop
+    handle_reception_event(self, event, data):
+        Apply a reception count or connection change reported by the reception thread
     process_ccsds_packet(self, ccsds_packet):
         Process the CCSDS packet and return BIOLAB packet
     notify_about_timeout(self):
@@ -208,6 +230,14 @@ class Receiver:
         logging.info(' # TCP timeout: %s seconds', waps_config["tcp_timeout"])
         self.connected = False
 
+        # Received CCSDS packets and connection changes are handed over to the main loop
+        # A full queue holds reception back until the main loop catches up
+        self.packet_queue = queue.Queue(maxsize=RECEPTION_QUEUE_SIZE)
+        self.reception_thread = None
+
+        # Image files are written in parallel, shut down at closeout
+        self.file_write_executor = ThreadPoolExecutor(max_workers=FILE_WRITE_WORKERS)
+
         # Check existence of output path
         if not os.path.exists(waps_config["output_path"]):
             logging.info("Output path does not exist. Creating it...\n...")
@@ -239,7 +269,21 @@ class Receiver:
 
         self.database = database.Database(self.database_file, self, waps_config["silent_db_creation"])
 
-        self.command_delay = waps_config["command_delay"]
+        # Yamcs command stack delay between missing packet commands in ms, parsed once
+        try:
+            self.command_delay = int(float(str(waps_config["command_delay"]).strip()))
+            if self.command_delay < 0:
+                raise ValueError
+        except (ValueError, OverflowError):
+            logging.error("%s%s%s", "Command delay is not a valid number of milliseconds: ",
+                          str(waps_config["command_delay"]),
+                          "\nExample: command_delay = 2500")
+            input("Press Enter to continue...")
+            sys.exit()
+        logging.info(' # Command stack delay: %i ms', self.command_delay)
+
+        # EC address to ec_states index lookup cache
+        self.ec_states_index = {}
 
         # Configure gui
         self.gui = None
@@ -266,7 +310,7 @@ class Receiver:
         self.images = []
 
         # Image to recover
-        self.recover_image_uuids = []
+        self.recover_image_uuids = set()
         self.clone_database = False
 
         # Status parameters
@@ -331,9 +375,16 @@ class Receiver:
     def get_ec_states_index(self, ec_address):
         """ Get EC index in the ec_states table based on ec address """
 
+        # Cached entry (ec_states may be replaced from outside, so verify it)
+        i = self.ec_states_index.get(ec_address)
+        if (i is not None and i < len(self.ec_states) and
+                self.ec_states[i]["ec_address"] == ec_address):
+            return i
+
         # Find existing entry
         for i, ec_state in enumerate(self.ec_states):
             if ec_state["ec_address"] == ec_address:
+                self.ec_states_index[ec_address] = i
                 return i
 
         # Create a new entry
@@ -343,6 +394,7 @@ class Receiver:
                     "transmission_active": False,
                     "last_memory_slot": None}
         self.ec_states.append(ec_state)
+        self.ec_states_index[ec_address] = len(self.ec_states) - 1
 
         return len(self.ec_states) - 1
 
@@ -368,9 +420,10 @@ class Receiver:
             if self.ec_states[index]["gui_column"] is None:
                 logging.warning(' All GUI columns are occupied already')
             elif self.gui:
-                logging.info(" EC address " + str(self.ec_states[index]["ec_address"]) +
-                             " with position " + self.ec_states[index]["ec_position"] +
-                             " occupies GUI column " + str(self.ec_states[index]["gui_column"]))
+                logging.info(" EC address %s with position %s occupies GUI column %s",
+                             self.ec_states[index]["ec_address"],
+                             self.ec_states[index]["ec_position"],
+                             self.ec_states[index]["gui_column"])
                 self.gui.update_column_occupation(self.ec_states[index]["gui_column"],
                                                   self.ec_states[index]["ec_address"],
                                                   self.ec_states[index]["ec_position"])
@@ -379,9 +432,9 @@ class Receiver:
         """ Clear GUI column assignment (from ec_states) """
 
         # Get current column occupation
-        for i, ec_state in enumerate(self.ec_states):
+        for ec_state in self.ec_states:
             if ec_state["gui_column"] == int(column):
-                self.ec_states[i]["gui_column"] = None
+                ec_state["gui_column"] = None
 
     def check_outdated_images(self):
         """
@@ -390,12 +443,16 @@ class Receiver:
         """
 
         if self.image_timeout != timedelta(0):
-            for index, image in enumerate(self.images):
-                if self.last_packet_ccsds_time > image.last_update + self.image_timeout:
-                    self.images[index].outdated = True
-                    self.database.update_image_status(image)
-                    if self.gui:
-                        self.gui.update_image_data(self.images[index])
+            # Images last updated before this time are outdated
+            outdated_before = self.last_packet_ccsds_time - self.image_timeout
+            outdated_images = [image for image in self.images
+                               if not image.outdated and image.last_update < outdated_before]
+            for image in outdated_images:
+                image.outdated = True
+                if self.gui:
+                    self.gui.update_image_data(image)
+            if outdated_images:
+                self.database.update_images_status(outdated_images)
 
     def remove_overwritten_image(self, index):
         """ Remove and overwritten image from active image list """
@@ -475,7 +532,7 @@ class Receiver:
 
         # If some images have been assigned to be recovered
         while len(self.recover_image_uuids) != 0:
-            image_uuid = self.recover_image_uuids.pop(0)
+            image_uuid = self.recover_image_uuids.pop()
             image = self.database.retrieve_image_by_uuid(image_uuid)
             if image is not None:
                 image.image_transmission_active = False
@@ -526,9 +583,6 @@ class Receiver:
             # Allowing more than double the time by default: 2.1 seconds
             self.socket.settimeout(float(self.tcp_timeout))
             self.socket.connect(self.server_address)
-            self.connected = True
-            if self.gui:
-                self.gui.update_server_connected()
 
             # Set TCP keepalive on an open socket
             if hasattr(socket, "SO_KEEPALIVE"):
@@ -584,7 +638,7 @@ class Receiver:
 
         while attempt < allowed_attempts:
             attempt = attempt + 1
-            self.tcp_rerequest_count = self.tcp_rerequest_count + 1
+            self.post_reception_event('rerequest')
             logging.debug('Expected data length of %i vs actual %i. Attempts: %i',
                           expected_length, data_length, attempt)
             recv_length = expected_length - data_length
@@ -601,34 +655,27 @@ class Receiver:
     def receive_ccsds_packet(self):
         """CCSDS packet reception with retries
         1. Receive CCSDS header
-        2 Update gui on CCSDS header reception
-        3. Receive the rest of CCSDS packet
+        2. Receive the rest of CCSDS packet
+        Runs in the reception thread, packets are counted by the main loop
         """
 
         # Get the next packet
         ccsds_header = self.receive_from_server(CCSDS_HEADERS_LENGTH)
-        self.timeout_notified = False
 
         received_header_length = len(ccsds_header)
 
-        # Increase packet count
-        if received_header_length > 0:
-            self.total_packets_received = self.total_packets_received + 1
         if received_header_length != CCSDS_HEADERS_LENGTH:
+            # A partial header still counts as a received packet
+            if received_header_length > 0:
+                self.post_reception_event('header')
             raise ValueError(f" Unexpected length of CCSDS header: {received_header_length} bytes {ccsds_header}")
 
-        # Update interfeace status
-        if self.gui:
-            self.gui.update_server_active()
-            self.gui.update_ccsds_count()
-
         ccsds1_packet_length = unpack('>H', ccsds_header[4:6])[0]
 
         # calculate & receive remaining bytes in packet:
         packet_data_length = ccsds1_packet_length + 1 - CCSDS2_HEADER_LENGTH
 
         packet_data = ccsds_header + self.receive_from_server(packet_data_length)
-        self.total_received_bytes = self.total_received_bytes + len(packet_data)
 
         return packet_data
 
@@ -680,26 +727,24 @@ class Receiver:
             ccsds2_element_id = (ccsds2_packet_id32 >> 27) & 0x0000000f
             ccsds2_packet_id27 = (ccsds2_packet_id32 >> 0) & 0x07ffffff
 
-            ccsds_str = f" New ccsds packet ({len(ccsds_packet)} bytes)\n      Received at {current_time}\n"
-
             str_type = "System"
             if ccsds1_type == 1:
                 str_type = "Payload"
-            ccsds_str = ccsds_str + f"      Type: {str_type} "
-            ccsds_str = ccsds_str + f"APID: {ccsds1_apid} "
-            ccsds_str = ccsds_str + f"Length: {ccsds1_packet_length}\n"
             str_element_id = "not mapped"
             if ccsds2_element_id == 2:
                 str_element_id = "Columbus"
-            ccsds_str = ccsds_str + f"      Element ID: {ccsds2_element_id} ({str_element_id}) "
-            ccsds_str = ccsds_str + f"Packet ID 27: {ccsds2_packet_id27}\n"
-            ccsds_str = ccsds_str + f"      Packet timestamp: (coarse: {ccsds2_coarse_time} "
-            ccsds_str = ccsds_str + f"fine: {ccsds2_fine_time}) {ccsds_time}"
 
-            logging.debug(ccsds_str)
+            logging.debug(" New ccsds packet (%i bytes)\n      Received at %s\n"
+                          "      Type: %s APID: %i Length: %i\n"
+                          "      Element ID: %i (%s) Packet ID 27: %i\n"
+                          "      Packet timestamp: (coarse: %i fine: %s) %s",
+                          ccsds_packet_length, current_time,
+                          str_type, ccsds1_apid, ccsds1_packet_length,
+                          ccsds2_element_id, str_element_id, ccsds2_packet_id27,
+                          ccsds2_coarse_time, ccsds2_fine_time, ccsds_time)
 
         except IndexError:
-            logging.error("CCSDS packet too short: {ccsds_packet_length} bytes")
+            logging.error("CCSDS packet too short: %d bytes", ccsds_packet_length)
             return None
 
         self.last_packet_ccsds_time = ccsds_time
@@ -779,14 +824,98 @@ class Receiver:
         logging.info("  Unexpected error count:      %d",
                      self.unexpected_error_count)
 
+    def reception_loop(self):
+        """Reception thread loop
+        The following actions are performed in the reception loop:
+        1. Connect to the TCP server if not already connected
+        2. Receive a CCSDS packet and queue it for the main loop
+        3. On any reception error besides timeout disconnect from the TC server
+        Reception counts, connection changes and errors are queued for the main loop as well.
+        The main loop is the only one updating the receiver statistics, connection state
+        and the gui, the reception thread only keeps its own failed connection count.
+        """
+
+        connected = False
+        while self.continue_running:
+            try:
+                if not connected:
+                    connected = self.connect_to_server()
+
+                    # If still not connected
+                    if not connected:
+                        time.sleep(1)  # Delay before trying to connect again
+                        continue
+                    self.post_reception_event('connected')
+
+                self.post_reception_event('packet', self.receive_ccsds_packet())
+
+            except (socket.timeout, TimeoutError):
+                # Timeout is noticed by the main loop from the empty queue
+                continue
+
+            except Exception as err:
+                if not self.continue_running:
+                    break
+                connected = False
+                self.socket.close()
+                self.post_reception_event('error', err)
+
+    def post_reception_event(self, event, data=None):
+        """Hand a reception event over to the main loop
+        Waits while the queue is full, unless the receiver is stopping
+
+        Args:
+            event (str): 'packet', 'header', 'rerequest', 'connected' or 'error'
+            data: CCSDS packet bytes or the reception error
+        """
+
+        while self.continue_running:
+            try:
+                self.packet_queue.put((event, data), timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def handle_reception_event(self, event, data):
+        """Apply a reception count or connection change reported by the reception thread
+
+        Args:
+            event (str): 'header', 'rerequest', 'connected' or 'error'
+            data: reception error for the 'error' event
+        """
+
+        if event == 'header':
+            # Packet with an incomplete CCSDS header
+            self.total_packets_received = self.total_packets_received + 1
+
+        elif event == 'rerequest':
+            self.tcp_rerequest_count = self.tcp_rerequest_count + 1
+
+        elif event == 'connected':
+            self.connected = True
+            if self.gui:
+                self.gui.update_server_connected()
+
+        elif event == 'error':
+            if self.connected:
+                logging.info(self.get_status() + '\n')
+            logging.error(str(data))
+            self.unexpected_error_count = self.unexpected_error_count + 1
+            self.connected = False
+            logging.info(' # Closed TCP connection')
+            if self.gui:
+                self.gui.update_server_disconnected()
+
     def start(self):
         """Main Receiver loop
+        CCSDS packets are received in a separate reception thread,
+        so that TCP reception is not blocked by packet processing and file writing.
         The following actions are performed in the main loop:
         1. Check prereception actions
-        2. Connect to the TCP server if not already connected
-        3. On any reception error besides timeout disconnect from the TC server
-        4. Process the CCSDS packet and check whether it contains BIOLAB TM
-        5. Update images according to received BIOLAB TM
+        2. Start the reception thread if not already running
+        3. Get the next CCSDS packets from the reception queue
+        4. Process the CCSDS packets and check whether they contain BIOLAB TM
+        5. Update images according to received BIOLAB TM, once per batch
         6. Write a status message in the terminal
         7. On timeout of reception indicate that no packets are being received
         8. On keyboard interrupt (Ctrl + C) or GUI close shut down the IES
@@ -798,23 +927,58 @@ class Receiver:
                 try:
                     self.prereception_actions()
 
-                    if not self.connected:
+                    if self.reception_thread is None:
                         if self.gui:
                             self.gui.update_server_disconnected()
-                        self.connected = self.connect_to_server()
-
-                        # If still not connected
-                        if not self.connected:
-                            time.sleep(1)  # Delay before trying to connect again
+                        self.reception_thread = threading.Thread(target=self.reception_loop,
+                                                                 daemon=True)
+                        self.reception_thread.start()
+
+                    try:
+                        reception_events = [self.packet_queue.get(timeout=self.tcp_timeout)]
+                    except queue.Empty:
+                        if self.connected:
+                            self.notify_about_timeout()
+                        continue
+
+                    # Take along whatever else is already waiting in the queue
+                    try:
+                        while len(reception_events) < PACKET_BATCH_SIZE:
+                            reception_events.append(self.packet_queue.get_nowait())
+                    except queue.Empty:
+                        pass
+
+                    ccsds_packets = []
+                    for event, data in reception_events:
+                        if event == 'packet':
+                            self.total_packets_received = self.total_packets_received + 1
+                            self.total_received_bytes = self.total_received_bytes + len(data)
+                            ccsds_packets.append(data)
+                        else:
+                            self.handle_reception_event(event, data)
+
+                    if ccsds_packets:
+                        self.timeout_notified = False
+                        # Update interface status
+                        if self.gui:
+                            self.gui.update_server_active()
+                            self.gui.update_ccsds_count()
+
+                    # A failing packet is counted and skipped, the rest of the batch goes on
+                    biolab_packets = []
+                    for ccsds_packet in ccsds_packets:
+                        try:
+                            biolab_packet = self.process_ccsds_packet(ccsds_packet)
+                        except Exception as err:
+                            logging.error(str(err))
+                            self.unexpected_error_count = self.unexpected_error_count + 1
                             continue
+                        if biolab_packet is not None:
+                            biolab_packets.append(biolab_packet)
 
-                    ccsds_packet = self.receive_ccsds_packet()
-                    biolab_packet = None
-                    biolab_packet = self.process_ccsds_packet(ccsds_packet)
-
-                    if biolab_packet is not None:
+                    if biolab_packets:
                         # Sort packets into images
-                        self.images = processor.sort_biolab_packets([biolab_packet],
+                        self.images = processor.sort_biolab_packets(biolab_packets,
                                                                     self.images,
                                                                     self,
                                                                     self.memory_slot_change_detection)
@@ -827,7 +991,7 @@ class Receiver:
 
                         # Show current state of incomplete images
                         # if a WAPS image packet has been received
-                        if biolab_packet.is_waps_image_packet:
+                        if any(packet.is_waps_image_packet for packet in biolab_packets):
                             processor.print_images_status(self.images)
 
                     # Status information after all of the processing
@@ -841,24 +1005,27 @@ class Receiver:
                             self.last_status_update = current_time
                             print(status_message, end='')
 
-                except (socket.timeout, TimeoutError):
-                    self.notify_about_timeout()
-
                 except KeyboardInterrupt:
                     raise KeyboardInterrupt
 
                 except Exception as err:
-                    if self.connected:
-                        logging.info(self.get_status() + '\n')
                     logging.error(str(err))
                     self.unexpected_error_count = self.unexpected_error_count + 1
-                    self.connected = False
-                    self.socket.close()
-                    logging.info(' # Closed TCP connection')
 
         except KeyboardInterrupt:
             logging.info(' # Keyboard interrupt, closing')
 
+        # Stop the reception thread
+        # A reception in progress can take up to 3 TCP timeouts
+        self.continue_running = False
+        if self.reception_thread is not None:
+            self.reception_thread.join(timeout=self.tcp_timeout*3 + 1)
+            if self.reception_thread.is_alive():
+                logging.warning(' Reception thread did not stop in time')
+
+        # Wait for any image file writes in progress
+        self.file_write_executor.shutdown(wait=True)
+
         # Close gui if it is running
         if self.gui:
             self.gui.close()
@@ -867,5 +1034,6 @@ class Receiver:
             self.database.database.close()
             logging.info(" # Closed database")
 
-        self.socket.close()
+        if self.socket:
+            self.socket.close()
         self.closeout_message()
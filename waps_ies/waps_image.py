@@ -14,6 +14,10 @@ Change Log:
 
 import uuid
 import logging
+import operator
+
+# Forged first uCAM packet with a JPEG header, used if the first packet is missing
+UCAM_FIRST_PACKET = bytes.fromhex('ffd8ffdb0084000d09090b0a080d0b0a0b0e0e0d0f13201513121213271c1e17202e2931302e292d2c333a4a3e333646372c2d405741464c4e525352323e5a615a50604a51524f010e0e0e131113261515264f352d354f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4fffc401a2000001050101010101010000000000000000')
 
 
 class WapsImage:
@@ -34,9 +38,12 @@ class WapsImage:
     ccsds_time (Time type): CCSDS time of the TM packet
     time_tag (int): EC time tag coming with this packet
     image_name (str): Image name compiled from other image parameters
+    duplicate_key (tuple): Parameters identifying a duplicate of this image
 
     packets (list): list of packets assigned to this image
     total_packets (int): Number of packets associated with this image
+    missing_packets_cache (dict): Missing packet lists of unchanged packets (internal)
+    missing_packets_cache_state (tuple): Packets and packet numbers the cache is valid for
 
     overwritten (bool): Whether image memory slot has been overwritten
     image_transmission_active (bool): Whether image transmission is ongoing
@@ -45,6 +52,10 @@ class WapsImage:
     latest_saved_file (str): Latest save file path (both uCAM and FLIR)
     latest_saved_file_tm (str): Latest save telemetry file path (only FLIR)
     latest_saved_file_data (str): Latest save data file path (only FLIR)
+    latest_saved_file_digest (tuple): Latest save file digest, size and modification time (internal)
+    latest_saved_file_tm_digest (tuple): Latest save telemetry file digest (internal, only FLIR)
+    latest_saved_file_data_digest (tuple): Latest save data file digest (internal, only FLIR)
+    saved_state (tuple): Packet state the latest saved files were made from (internal)
     outdated (bool): Indication of whether image has been not update for a defined period
 
     Methods
@@ -53,13 +64,13 @@ class WapsImage:
         Image creation based on the initialization packet
     __str__(self):
         Create a string from packet variables
-    missing_packets_string(self,  exclude_corrupted=False):
+    missing_packets_string(self,  exclude_corrupted=False, missing_packets=None):
         List all missing packets as a string. Possible to exclude corrupted
     add_packet(self, packet):
         Add packet to the image packet list with basic check and time update
     is_complete(self):
         Return whether the image is complete
-    get_completeness_str(self):
+    get_completeness_str(self, missing_packets=None):
         Return image completeness string with percentage
     get_missing_packets(self, exclude_corrupted=False):
         List all missing packets. Possible to exclude corrupted (for reconstruction)
@@ -100,9 +111,16 @@ class WapsImage:
                            self.ccsds_time.strftime('%H%M%S') + '_' +
                            'm' + str(self.memory_slot) + '_' +
                            str(self.time_tag))
+        self.duplicate_key = (self.ec_address,
+                              self.camera_type,
+                              self.memory_slot,
+                              self.number_of_packets,
+                              self.time_tag)
 
         self.packets = []
         self.total_packets = 0
+        self.missing_packets_cache = {}
+        self.missing_packets_cache_state = None
 
         # Other variables
         self.overwritten = False
@@ -112,12 +130,16 @@ class WapsImage:
         self.latest_saved_file = None
         self.latest_saved_file_tm = None
         self.latest_saved_file_data = None
+        self.latest_saved_file_digest = None
+        self.latest_saved_file_tm_digest = None
+        self.latest_saved_file_data_digest = None
+        self.saved_state = None
         self.outdated = False
 
     def __str__(self):
         """ Image metadata printout """
 
-        self.packets = self.sort_packets()
+        # Read-only: packets are not sorted here, only their IDs
         missing_packets = self.get_missing_packets()
 
         good_packets = self.number_of_packets-len(missing_packets)
@@ -141,23 +163,24 @@ class WapsImage:
                "\n - Memory Slot overwritten: " + str(self.overwritten))
 
         if not self.image_transmission_active and len(missing_packets) > 0:
+            missing_packet_set = set(missing_packets)
             first_packet_id = 0
             previous_packet_id = -1
             out = out + '\n - Correct Packets: \t ['
             first_entry = True
-            for packet in self.packets:
-                if packet.tm_packet_id not in missing_packets:
-                    current_packet_id = packet.tm_packet_id
-                    if not current_packet_id == previous_packet_id + 1:
-                        if not first_entry:
-                            out = out + ', '
-                        if first_packet_id == previous_packet_id:
-                            out = out + str(first_packet_id)
-                        else:
-                            out = out + (str(first_packet_id) +
-                                         '-' + str(previous_packet_id))
-                        first_packet_id = current_packet_id
-                        first_entry = False
+            correct_packet_ids = sorted({packet.tm_packet_id for packet in self.packets} -
+                                        missing_packet_set)
+            for current_packet_id in correct_packet_ids:
+                if not current_packet_id == previous_packet_id + 1:
+                    if not first_entry:
+                        out = out + ', '
+                    if first_packet_id == previous_packet_id:
+                        out = out + str(first_packet_id)
+                    else:
+                        out = out + (str(first_packet_id) +
+                                     '-' + str(previous_packet_id))
+                    first_packet_id = current_packet_id
+                    first_entry = False
                 previous_packet_id = current_packet_id
             if not first_entry:
                 out = out + ', '
@@ -182,35 +205,30 @@ class WapsImage:
 
         return out
 
-    def missing_packets_string(self,  exclude_corrupted=False):
-        """ Number sequence printout """
+    def missing_packets_string(self,  exclude_corrupted=False, missing_packets=None):
+        """ Number sequence printout
+        An already retrieved missing packet list can be given
+        """
 
-        number_list = self.get_missing_packets(exclude_corrupted)
+        number_list = missing_packets
+        if number_list is None:
+            number_list = self.get_missing_packets(exclude_corrupted)
 
         if len(number_list) == 0:
             return ""
-        if len(number_list) == 1:
-            return str(number_list[0])
 
-        previous_number = number_list[0]
-        last_number = number_list[0]
-        out = str(previous_number)
-        dash_added = False
+        # Runs of consecutive numbers, joined once at the end
+        runs = []
+        run_start = previous_number = number_list[0]
         for num in number_list[1:]:
-            if (num == previous_number + 1 and not dash_added):
-                out = out + '-'
-                dash_added = True
-            elif num != previous_number + 1:
-                if last_number != previous_number:
-                    out = out + str(previous_number)
-                out = out + ', ' + str(num)
-                last_number = num
-                dash_added = False
+            if num != previous_number + 1:
+                runs.append((run_start, previous_number))
+                run_start = num
             previous_number = num
-        if last_number != previous_number:
-            out = out + str(previous_number)
+        runs.append((run_start, previous_number))
 
-        return out
+        return ', '.join([str(first) if first == last else str(first) + '-' + str(last)
+                          for first, last in runs])
 
     def add_packet(self, packet):
         """ Append a new packet to an existing list
@@ -226,6 +244,8 @@ class WapsImage:
         if not self.know_number_of_packets:
             if self.number_of_packets <= packet.tm_packet_id:
                 self.number_of_packets = packet.tm_packet_id + 1
+                self.duplicate_key = self.duplicate_key[:3] + (self.number_of_packets,
+                                                               self.time_tag)
 
         # Last update of image packets
         if self.last_update < packet.ccsds_time:
@@ -254,12 +274,14 @@ class WapsImage:
 
         return True
 
-    def get_completeness_str(self):
+    def get_completeness_str(self, missing_packets=None):
         """ Get percentage and packet count string
         Received good packets / Expeced packet and percentage string
+        An already retrieved missing packet list can be given
         """
 
-        missing_packets = self.get_missing_packets()
+        if missing_packets is None:
+            missing_packets = self.get_missing_packets()
         available_packets = self.number_of_packets - len(missing_packets)
         percentage = int(100.0*(available_packets)/self.number_of_packets)
         out = (str(percentage) + '% (' +
@@ -271,16 +293,28 @@ class WapsImage:
     def get_missing_packets(self, exclude_corrupted=False):
         """ Get the missing packet list
         For reconstruction possible to specify to allow corrupted packets
+        Result is cached until the packet list, its length or the number of packets change.
+        The returned list is the cached one, callers must not change it.
         """
 
+        # Reuse the previous result if packets are unchanged
+        cache_state = (self.packets, len(self.packets), self.number_of_packets)
+        if (self.missing_packets_cache_state is None or
+                self.missing_packets_cache_state[0] is not cache_state[0] or
+                self.missing_packets_cache_state[1:] != cache_state[1:]):
+            self.missing_packets_cache = {}
+            self.missing_packets_cache_state = cache_state
+        elif exclude_corrupted in self.missing_packets_cache:
+            return self.missing_packets_cache[exclude_corrupted]
+
         missing_packets = []
         try:
             # Check if all the correct packets are present
             completeness_array = [0] * self.number_of_packets
-            for i, packet in enumerate(self.packets):
+            for packet in self.packets:
                 if (packet.is_good_waps_image_packet() or
                         exclude_corrupted):
-                    completeness_array[self.packets[i].tm_packet_id] = 1
+                    completeness_array[packet.tm_packet_id] = 1
 
             for i, present in enumerate(completeness_array):
                 if not present:
@@ -288,11 +322,12 @@ class WapsImage:
 
         except IndexError:
             logging.warning('%s - Unexpected tm packet id %i. Number image packets: %i. Actual packets: %i',
-                            self.packets[i].packet_name,
-                            self.packets[i].tm_packet_id,
+                            packet.packet_name,
+                            packet.tm_packet_id,
                             self.number_of_packets,
                             len(self.packets))
 
+        self.missing_packets_cache[exclude_corrupted] = missing_packets
         return missing_packets
 
     def packets_are_sequential(self):
@@ -317,6 +352,13 @@ class WapsImage:
     def sort_packets(self):
         """ Sort the packets of this image according to data packet number """
 
+        # Packets usually arrive in order, then there is nothing to sort
+        # and no duplicates to look for
+        packet_ids = [packet.tm_packet_id for packet in self.packets]
+        if (all(map(operator.lt, packet_ids, packet_ids[1:])) and
+                (not packet_ids or packet_ids[-1] < self.number_of_packets)):
+            return self.packets
+
         # Sorting based of data packet number
         def get_packet_number(packet):
             return packet.tm_packet_id
@@ -333,8 +375,8 @@ class WapsImage:
                                 self.packets[i+1].packet_name)
                 if self.packets[i].data[90:] != self.packets[i+1].data[90:]:
                     logging.error(" DUPLICATE packets, data not identical. Later one might belong to a non-initialized image")
-                    logging.debug(' DUPLICATE #1 %s', str(self.packets[i]))
-                    logging.debug(' DUPLICATE #2 %s', str(self.packets[i+1]))
+                    logging.debug(' DUPLICATE #1 %s', self.packets[i])
+                    logging.debug(' DUPLICATE #2 %s', self.packets[i+1])
                 if (self.packets[i].ccsds_time <= self.packets[i+1].ccsds_time or
                         (self.packets[i+1].is_good_waps_image_packet() and
                          not self.packets[i].is_good_waps_image_packet())):
@@ -356,10 +398,11 @@ class WapsImage:
 
         # Check for missing packets (reconstruct image in any case)
         accept_corrupted = True
-        # Exclude corrupted packets
-        missing_packets = self.get_missing_packets(accept_corrupted)
+        # Exclude corrupted packets, as a set for membership checks
+        missing_packets = set(self.get_missing_packets(accept_corrupted))
 
-        image_data = bytearray(0)
+        # Packet payloads are collected and joined once at the end
+        image_parts = []
 
         if self.camera_type == 'uCAM':
 
@@ -370,14 +413,13 @@ class WapsImage:
                 if i in missing_packets:
                     if i == 0:
                         # First packet can be forged
-                        image_data = image_data + bytes.fromhex('ffd8ffdb0084000d09090b0a080d0b0a0b0e0e0d0f13201513121213271c1e17202e2931302e292d2c333a4a3e333646372c2d405741464c4e525352323e5a615a50604a51524f010e0e0e131113261515264f352d354f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4f4fffc401a2000001050101010101010000000000000000')
+                        image_parts.append(UCAM_FIRST_PACKET)
                     else:  # Default length
-                        image_data = image_data + bytearray(158)
+                        image_parts.append(bytes(158))
                 else:
                     packet_size = self.packets[available_i].data_packet_size
-                    image_data = (image_data +
-                                  self.packets[available_i].data[94:94 +
-                                                                 packet_size])
+                    image_parts.append(self.packets[available_i].data[94:94 +
+                                                                      packet_size])
                     available_i = available_i + 1
 
         elif self.camera_type == 'FLIR':
@@ -387,10 +429,11 @@ class WapsImage:
             for i in range(self.number_of_packets):
                 # Fill missing packet data
                 if i in missing_packets:
-                    image_data = image_data + bytearray(160)  # Default length
+                    image_parts.append(bytes(160))  # Default length
                 else:
-                    image_data = (image_data +
-                                  self.packets[available_i].data[94:])
+                    image_parts.append(self.packets[available_i].data[94:])
                     available_i = available_i + 1
 
+        image_data = bytearray().join(image_parts)
+
         return image_data
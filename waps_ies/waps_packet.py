@@ -12,10 +12,32 @@ Change Log:
  - release
 """
 
-from struct import unpack
-import uuid
+from struct import Struct
+from binascii import crc_hqx
+from itertools import count
+import os
 import logging
 
+# Precompiled big-endian BIOLAB TM field formats
+UINT16 = Struct('>H')
+# Whole BIOLAB TM header in one read:
+# EC address (2), time tag (4), memory slot word (56),
+# Generic TM ID, type, length (84) and the two following WAPS words (90)
+BIOLAB_HEADER = Struct('>2xBxi48xH26xHHHHH')
+
+# Packet UUIDs: random upper half per session, sequential lower half
+PACKET_UUID_COUNTER = count(int.from_bytes(os.urandom(8), 'big') << 64)
+
+# Generic TM IDs of WAPS image initialization packets
+INIT_TM_IDS = frozenset((0x4100, 0x5100))
+
+# Packet values the detailed packet check depends on,
+# assigning any of them discards the stored check result
+CHECKED_PACKET_VALUES = frozenset(('data', 'is_waps_image_packet', 'generic_tm_id',
+                                   'image_memory_slot', 'tm_packet_id', 'data_packet_id',
+                                   'data_packet_size', 'data_packet_crc',
+                                   'data_packet_verify_code'))
+
 
 class WapsPacket:
     """WAPS Image Packet class
@@ -27,7 +49,7 @@ class WapsPacket:
     receiver (Receiver type): current waps_ies.Receiver instance
     acquisition_time (Time type): time of packet creation
     ccsds_time (Time type): CCSDS time of the TM packet
-    data (bytearray): BIOLAB TM packet data
+    data (bytes): BIOLAB TM packet data, immutable
 
     packet_name (str): Packet name compiled from other packet parameters
 
@@ -51,73 +73,108 @@ class WapsPacket:
 
     image_uuid (str): Assigned image UUID
 
+    good_packet (bool): Result of the detailed packet check, None until checked
+
     Methods
     -------
     __init__(self, ccsds_time, acquisition_time, data, receiver=None):
         Packet initialization based on acquisition time, ccsds time and packet data
+    __setattr__(self, name, value):
+        Set packet value, discarding the packet check result if the check depends on it
+    parse_init_words(self, waps_word_1, waps_word_2):
+        WAPS image initialization packet values
+    parse_flir_data_words(self, waps_word_1, waps_word_2):
+        WAPS FLIR image data packet values
+    parse_ucam_data_words(self, waps_word_1, waps_word_2):
+        WAPS uCAM image data packet values
     __str__(self):
         Create a string from packet variables
     in_spec(self):
         Check basic packet specs
     is_good_waps_image_packet(self, count_corruption=False):
+        Check details packet parameters once, reusing the result afterwards
+    check_waps_image_packet(self, count_corruption=False):
         Check details packet parameters including CRC or Verify Code
+    check_flir_data_packet(self, count_corruption=False):
+        Check FLIR data packet ID and CRC
+    check_ucam_data_packet(self, count_corruption=False):
+        Check uCAM data packet ID and Verify Code
     """
 
-    time_tag = -1
-    ec_address = -1
-    generic_tm_id = -1
-    generic_tm_type = -1
-    generic_tm_length = -1
-
-    is_waps_image_packet = False
-
-    # WAPS image data packet values
-    image_number_of_packets = -1
-    data_packet_id = -1
-    data_packet_size = -1
-    data_packet_crc = -1
-    data_packet_verify_code = -1
-
-    # Unique ID
-    image_uuid = -1
-
-    # If the packet is corrupted - declare it only once per packet load
-    packet_corruption_declared = False
+    # Fixed attribute layout, packets are created for every BIOLAB TM packet
+    __slots__ = ('uuid', 'receiver', 'acquisition_time', 'ccsds_time', 'data',
+                 'packet_name', 'ec_address', 'time_tag',
+                 'biolab_current_image_memory_slot',
+                 'generic_tm_id', 'generic_tm_type', 'generic_tm_length',
+                 'image_memory_slot', 'tm_packet_id', 'is_waps_image_packet',
+                 'image_number_of_packets', 'data_packet_id',
+                 'data_packet_size', 'data_packet_crc',
+                 'data_packet_verify_code', 'image_uuid',
+                 'packet_corruption_declared', 'good_packet')
 
     def __init__(self, ccsds_time, acquisition_time, data, receiver=None):
         """ Packet initialization with metadata """
 
-        self.uuid = str(uuid.uuid4())  # Random UUID
+        # Unique ID in UUID text form, without a random draw per packet
+        uuid_hex = '%032x' % next(PACKET_UUID_COUNTER)
+        self.uuid = '-'.join((uuid_hex[:8], uuid_hex[8:12], uuid_hex[12:16],
+                              uuid_hex[16:20], uuid_hex[20:]))
         self.receiver = receiver
 
         self.acquisition_time = acquisition_time
         self.ccsds_time = ccsds_time
-        self.data = data
+        # Immutable bytes buffer (no copy if bytes are given already)
+        self.data = bytes(data)
 
-        self.packet_name = 'pkt_' + self.ccsds_time.strftime('%Y%m%d_%H%M%S')
+        self.time_tag = -1
+        self.ec_address = -1
+        self.generic_tm_id = -1
+        self.generic_tm_type = -1
+        self.generic_tm_length = -1
+        self.image_memory_slot = -1
+        self.tm_packet_id = -1
+
+        self.is_waps_image_packet = False
+
+        # WAPS image data packet values
+        self.image_number_of_packets = -1
+        self.data_packet_id = -1
+        self.data_packet_size = -1
+        self.data_packet_crc = -1
+        self.data_packet_verify_code = -1
+
+        # Unique ID
+        self.image_uuid = -1
+
+        # If the packet is corrupted - declare it only once per packet load
+        self.packet_corruption_declared = False
+
+        # Detailed packet check result, checked on first use
+        self.good_packet = None
+
+        # CCSDS time string is formatted once for both packet names
+        ccsds_time_string = self.ccsds_time.strftime('%Y%m%d_%H%M%S')
+        self.packet_name = 'pkt_' + ccsds_time_string
 
         if len(self.data) < 254:
             logging.error(' Unexpectedly short packet data: %i',
                           len(self.data))
             return
 
-        # And then sort them out from data
-        # EC address
-        self.ec_address = self.data[2]
-        # Packet time tag
-        self.time_tag = unpack('>i', self.data[4:8])[0]
-
-        # Last taken image memory slot
-        val = unpack('>H', self.data[56:58])[0] >> 12
-        self.biolab_current_image_memory_slot = val
-
+        # And then sort them out from data, all header fields at once
+        # EC address, packet time tag, last taken image memory slot,
         # Generic TM ID 0x4100, Generic TM Type set
-        # with corresponding Picture ID, 0 to 7, and Packet ID to 0x000
-        self.generic_tm_id = unpack('>H', self.data[84:86])[0]
-        # Generic TM Type
-        self.generic_tm_type = unpack('>H', self.data[86:88])[0]
-        # Generic TM data length
-        self.generic_tm_length = unpack('>H', self.data[88:90])[0]
+        # with corresponding Picture ID, 0 to 7, and Packet ID to 0x000,
+        # Generic TM data length and two WAPS image packet words
+        (self.ec_address,
+         self.time_tag,
+         memory_slot_word,
+         self.generic_tm_id,
+         self.generic_tm_type,
+         self.generic_tm_length,
+         waps_word_1,
+         waps_word_2) = BIOLAB_HEADER.unpack_from(self.data)
+        self.biolab_current_image_memory_slot = memory_slot_word >> 12
 
         # WAPS Image Memory slot
         self.image_memory_slot = self.generic_tm_type >> 12
@@ -126,39 +183,50 @@ class WapsPacket:
 
         self.packet_name = ('pkt_ec_' + str(self.ec_address) +
                             '_m' + str(self.image_memory_slot) +
-                            '_' + self.ccsds_time.strftime('%Y%m%d_%H%M%S') +
+                            '_' + ccsds_time_string +
                             '_' + str(self.time_tag))
 
-        if self.generic_tm_id in (0x4100, 0x4200, 0x5100, 0x5200):
-
+        # WAPS image packet values according to Generic TM ID
+        parse_waps_words = WAPS_PACKET_PARSERS.get(self.generic_tm_id)
+        if parse_waps_words is not None:
             self.is_waps_image_packet = True
-
-            if self.generic_tm_id in (0x4100, 0x5100):
-                # WAPS Image number of packets (FLIR or uCAM)
-                self.image_number_of_packets = unpack('>H',
-                                                      self.data[90:92])[0]
-
-            elif self.generic_tm_id == 0x4200:
-                # WAPS FLIR Data packet ID
-                # 4 upper bits are reserved
-                self.data_packet_id = unpack('>H',
-                                             self.data[90:92])[0] & 0x0FFF
-                # WAPS FLIR Data packet CRC
-                self.data_packet_crc = unpack('>H', self.data[92:94])[0]
-
-            elif self.generic_tm_id == 0x5200:
-                # WAPS uCAM Data packet ID
-                self.data_packet_id = unpack('>H', self.data[90:92])[0]
-                # WAPS uCAM Data packet size
-                self.data_packet_size = unpack('>H', self.data[92:94])[0]
-                # WAPS uCAM Data packet verification code
-
-                val = self.data[94 + self.data_packet_size:94 +
-                                self.data_packet_size + 2]
-                self.data_packet_verify_code = unpack('>H', val)[0]
+            parse_waps_words(self, waps_word_1, waps_word_2)
         else:
             self.is_waps_image_packet = False
 
+    def __setattr__(self, name, value):
+        """ Set packet value, a changed checked value needs a new packet check """
+
+        object.__setattr__(self, name, value)
+        if name in CHECKED_PACKET_VALUES:
+            object.__setattr__(self, 'good_packet', None)
+
+    def parse_init_words(self, waps_word_1, waps_word_2):
+        """ WAPS image initialization packet values (FLIR or uCAM) """
+
+        # WAPS Image number of packets
+        self.image_number_of_packets = waps_word_1
+
+    def parse_flir_data_words(self, waps_word_1, waps_word_2):
+        """ WAPS FLIR image data packet values """
+
+        # WAPS FLIR Data packet ID
+        # 4 upper bits are reserved
+        self.data_packet_id = waps_word_1 & 0x0FFF
+        # WAPS FLIR Data packet CRC
+        self.data_packet_crc = waps_word_2
+
+    def parse_ucam_data_words(self, waps_word_1, waps_word_2):
+        """ WAPS uCAM image data packet values """
+
+        # WAPS uCAM Data packet ID
+        self.data_packet_id = waps_word_1
+        # WAPS uCAM Data packet size
+        self.data_packet_size = waps_word_2
+        # WAPS uCAM Data packet verification code
+        self.data_packet_verify_code = UINT16.unpack_from(self.data,
+                                                          94 + self.data_packet_size)[0]
+
     def __str__(self):
         """Packet metadata"""
 
@@ -231,6 +299,25 @@ class WapsPacket:
 
     def is_good_waps_image_packet(self, count_corruption=False):
         """Detailed check of packet parameters
+        The packet is checked once, the result is kept until a checked packet value
+        is assigned (see CHECKED_PACKET_VALUES). Warnings are logged by the check itself.
+        Corruption is always counted with a new check.
+
+        Args:
+            self
+            count_corruption (bool): Whether to count corruption this IES session
+
+        Returns:
+            good_packet (bool): Packet has no issues
+        """
+
+        if count_corruption or self.good_packet is None:
+            self.good_packet = self.check_waps_image_packet(count_corruption)
+
+        return self.good_packet
+
+    def check_waps_image_packet(self, count_corruption=False):
+        """Detailed check of packet parameters including CRC or Verify Code
 
         Args:
             self
@@ -260,77 +347,98 @@ class WapsPacket:
                           self.packet_name)
             return False
 
-        if self.generic_tm_id == 0x4200:
-
-            if self.data_packet_id != self.tm_packet_id:
-                logging.debug('%s - packet id inconsistent: %i vs %i',
-                              self.packet_name,
-                              self.tm_packet_id,
-                              self.data_packet_id)
-
-            # Calculate CRC for FLIR data packets.
-            crc_data = bytearray(self.data[90:])
-            crc_data[0] = crc_data[0] & 0x0F  # 4 upper bits reserved
-            crc_data[2] = 0  # CRC itself is zero for CRC calculation
-            crc_data[3] = 0  # CRC itself is zero for CRC calculation
-
-            def crc16_ccitt(crc, data):
-                """
-                CRC calculation function (16-bit XMODEM CRC-CCITT
-                with initial value of zero, over the entire message)
-                Width = 16 bits
-                Truncated polynomial = 0x1021
-                Initial value = 0x0000
-                """
-                msb = crc >> 8
-                lsb = crc & 255
-                for c in data:
-                    x = int(c) ^ msb
-                    x ^= (x >> 4)
-                    msb = (lsb ^ (x >> 3) ^ (x << 4)) & 255
-                    lsb = (x ^ (x << 5)) & 255
-                return (msb << 8) + lsb
-
-            if crc16_ccitt(0, crc_data) != self.data_packet_crc:
-                if not self.packet_corruption_declared:
-                    logging.warning('%s - CRC mismatch. %i packet is likely corrupted',
-                                    self.packet_name, self.tm_packet_id)
-                    self.packet_corruption_declared = True
-
-                if self.receiver is not None and count_corruption:
-                    self.receiver.total_corrupted_packets = self.receiver.total_corrupted_packets + 1
+        # Data packet CRC or Verify Code check according to Generic TM ID
+        check_data_packet = WAPS_PACKET_CHECKS.get(self.generic_tm_id)
+        if check_data_packet is not None:
+            return check_data_packet(self, count_corruption)
 
-                return False
+        return True
 
-        if self.generic_tm_id == 0x5200:
+    def check_flir_data_packet(self, count_corruption=False):
+        """FLIR data packet check of packet ID and CRC
 
-            if self.data_packet_id != self.tm_packet_id + 1:
-                logging.warning('%s - packet id inconsistent: %i vs %i',
-                                self.packet_name,
-                                self.tm_packet_id,
-                                self.data_packet_id)
+        Args:
+            self
+            count_corruption (bool): Whether to count corruption this IES session
+
+        Returns:
+            good_packet (bool): Packet has no issues
+        """
+
+        if self.data_packet_id != self.tm_packet_id:
+            logging.debug('%s - packet id inconsistent: %i vs %i',
+                          self.packet_name,
+                          self.tm_packet_id,
+                          self.data_packet_id)
 
-            # Calculate Verify Code for uCAM data packets.
-            # (biolab + id and length + data length + verify code + 1)
-            verify_data = self.data[90:90+4+self.data_packet_size+2]
+        # Calculate CRC for FLIR data packets.
+        crc_data = bytearray(self.data[90:])
+        crc_data[0] = crc_data[0] & 0x0F  # 4 upper bits reserved
+        crc_data[2] = 0  # CRC itself is zero for CRC calculation
+        crc_data[3] = 0  # CRC itself is zero for CRC calculation
 
-            calc_verif_code = 0
-            for byte in verify_data[:-2]:
-                calc_verif_code = calc_verif_code + byte
-            # Only the lower byte is taken
-            calc_verif_code = (calc_verif_code & 0x00FF) << 8
+        # 16-bit XMODEM CRC-CCITT (polynomial 0x1021, initial value 0)
+        if crc_hqx(crc_data, 0) != self.data_packet_crc:
+            if not self.packet_corruption_declared:
+                logging.warning('%s - CRC mismatch. %i packet is likely corrupted',
+                                self.packet_name, self.tm_packet_id)
+                self.packet_corruption_declared = True
 
-            if calc_verif_code != self.data_packet_verify_code:
-                if not self.packet_corruption_declared:
-                    logging.warning('%s - Verify code mismatch. %i packet is likely corrupted',
-                                    self.packet_name, self.tm_packet_id)
-                    self.packet_corruption_declared = True
+            if self.receiver is not None and count_corruption:
+                self.receiver.total_corrupted_packets = self.receiver.total_corrupted_packets + 1
 
-                if self.receiver is not None:
-                    if count_corruption and not self.receiver.skip_verify_code:
-                        self.receiver.total_corrupted_packets = self.receiver.total_corrupted_packets + 1
-                    if self.receiver.skip_verify_code:
-                        return True
-                return False
+            return False
 
         return True
+
+    def check_ucam_data_packet(self, count_corruption=False):
+        """uCAM data packet check of packet ID and Verify Code
+
+        Args:
+            self
+            count_corruption (bool): Whether to count corruption this IES session
+
+        Returns:
+            good_packet (bool): Packet has no issues
+        """
+
+        if self.data_packet_id != self.tm_packet_id + 1:
+            logging.warning('%s - packet id inconsistent: %i vs %i',
+                            self.packet_name,
+                            self.tm_packet_id,
+                            self.data_packet_id)
+
+        # Calculate Verify Code for uCAM data packets.
+        # (biolab + id and length + data length + verify code + 1)
+        verify_data = self.data[90:90+4+self.data_packet_size+2]
+
+        # Sum of all bytes except the verify code itself
+        calc_verif_code = sum(verify_data[:-2])
+        # Only the lower byte is taken
+        calc_verif_code = (calc_verif_code & 0x00FF) << 8
+
+        if calc_verif_code != self.data_packet_verify_code:
+            if not self.packet_corruption_declared:
+                logging.warning('%s - Verify code mismatch. %i packet is likely corrupted',
+                                self.packet_name, self.tm_packet_id)
+                self.packet_corruption_declared = True
+
+            if self.receiver is not None:
+                if count_corruption and not self.receiver.skip_verify_code:
+                    self.receiver.total_corrupted_packets = self.receiver.total_corrupted_packets + 1
+                if self.receiver.skip_verify_code:
+                    return True
+            return False
+
+        return True
+
+
+# WAPS image packet value parsing according to Generic TM ID
+WAPS_PACKET_PARSERS = {0x4100: WapsPacket.parse_init_words,
+                       0x5100: WapsPacket.parse_init_words,
+                       0x4200: WapsPacket.parse_flir_data_words,
+                       0x5200: WapsPacket.parse_ucam_data_words}
+
+# WAPS data packet checks according to Generic TM ID
+WAPS_PACKET_CHECKS = {0x4200: WapsPacket.check_flir_data_packet,
+                      0x5200: WapsPacket.check_ucam_data_packet}